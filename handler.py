@@ -1,11 +1,17 @@
 import runpod
 from runpod.serverless.utils import upload_file_to_bucket
+from runpod.serverless.utils.rp_upload import get_boto_client
 import json
+import queue
+import shutil
 import urllib.parse
 import time
 import os
+import re
 import requests
 import base64
+import hashlib
+import math
 from io import BytesIO
 import websocket
 import uuid
@@ -13,8 +19,24 @@ import tempfile
 import socket
 import traceback
 import argparse
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import shlex
+import subprocess
+import sys
+import threading
  
 
+try:
+    # orjson decodes websocket frames several times faster than the stdlib; optional
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 # Ensure AWS SDK checksum behavior is compatible with GCS S3-compatible API
 os.environ.setdefault("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
 os.environ.setdefault("AWS_RESPONSE_CHECKSUM_VALIDATION", "when_required")
@@ -41,6 +63,362 @@ if os.environ.get("WEBSOCKET_TRACE", "false").lower() == "true":
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
 
+# ComfyUI process supervision (can be overridden through environment variables)
+#   • COMFY_SUPERVISOR=true makes this handler launch ComfyUI itself, watch its PID and
+#     restart it with exponential backoff whenever it dies (e.g. OOM-kill mid-job).
+#     start.sh exports it and then skips its own background launch.
+#   • COMFY_APP_DIR is the ComfyUI checkout to run main.py from (exported by start.sh).
+#   • COMFY_EXTRA_ARGS are appended to the `python main.py --verbose` command line.
+#   • COMFY_RESTART_WAIT_S is how long an incoming job waits for a restart to complete.
+#   • COMFY_RESUBMIT_ON_CRASH=true resubmits the job once if ComfyUI crashed under it
+#     (can also be requested per job through the `resubmit_on_crash` input flag).
+COMFY_SUPERVISOR_ENABLED = os.environ.get("COMFY_SUPERVISOR", "false").lower() == "true"
+COMFY_APP_DIR = os.environ.get("COMFY_APP_DIR", "/workspace/ComfyUI")
+COMFY_LOG_PATH = os.environ.get("COMFY_LOG_PATH", "/tmp/comfyui.log")
+COMFY_EXTRA_ARGS = shlex.split(os.environ.get("COMFY_EXTRA_ARGS", ""))
+COMFY_STARTUP_TIMEOUT_S = int(os.environ.get("COMFY_STARTUP_TIMEOUT_S", 180))
+COMFY_RESTART_BACKOFF_S = float(os.environ.get("COMFY_RESTART_BACKOFF_S", 2))
+COMFY_RESTART_BACKOFF_MAX_S = float(os.environ.get("COMFY_RESTART_BACKOFF_MAX_S", 60))
+# A process that stayed up this long is considered stable again and resets the backoff
+COMFY_RESTART_BACKOFF_RESET_S = float(os.environ.get("COMFY_RESTART_BACKOFF_RESET_S", 300))
+COMFY_RESTART_WAIT_S = int(os.environ.get("COMFY_RESTART_WAIT_S", 120))
+COMFY_LOG_TAIL_LINES = int(os.environ.get("COMFY_LOG_TAIL_LINES", 200))
+COMFY_RESUBMIT_ON_CRASH = os.environ.get("COMFY_RESUBMIT_ON_CRASH", "false").lower() == "true"
+
+# Server-side workflow templates (can be overridden through environment variables)
+#   • WORKFLOW_TEMPLATES_DIR holds <template_id>.json files (ComfyUI API format).
+#   • WORKFLOW_TEMPLATES_RESCAN_S is the minimum interval between checks for changed files.
+WORKFLOW_TEMPLATES_DIR = os.environ.get("WORKFLOW_TEMPLATES_DIR", "/runpod-volume/workflows")
+WORKFLOW_TEMPLATES_RESCAN_S = float(os.environ.get("WORKFLOW_TEMPLATES_RESCAN_S", 5))
+
+# Model inventory (can be overridden through environment variables)
+#   • MODEL_INDEX_DIR is the models directory start.sh links to the volume.
+#   • MODEL_INDEX_REFRESH_S sets how often changed directories are rescanned.
+#   • MODEL_INDEX_HASH=true computes sha256 of model files in the background; hashes are
+#     kept in MODEL_INDEX_CACHE_PATH so they survive worker restarts.
+#   • MODEL_INDEX_ENFORCE=false disables rejecting jobs whose core loader nodes
+#     (CheckpointLoaderSimple, UNETLoader, LoraLoader, ...) reference missing models.
+MODEL_INDEX_DIR = os.environ.get("MODEL_INDEX_DIR", os.path.join(COMFY_APP_DIR, "models"))
+MODEL_INDEX_REFRESH_S = float(os.environ.get("MODEL_INDEX_REFRESH_S", 60))
+MODEL_INDEX_HASH = os.environ.get("MODEL_INDEX_HASH", "false").lower() == "true"
+MODEL_INDEX_CACHE_PATH = os.environ.get(
+    "MODEL_INDEX_CACHE_PATH", "/runpod-volume/.cache/model_index.json"
+)
+MODEL_INDEX_ENFORCE = os.environ.get("MODEL_INDEX_ENFORCE", "true").lower() == "true"
+
+# Local model tier (can be overridden through environment variables)
+#   • MODEL_CACHE_MAX_GB > 0 enables copying hot model files from the network volume to
+#     MODEL_CACHE_DIR on container disk, evicting least recently used files to stay
+#     within the budget. ComfyUI picks the local copies first through a generated
+#     extra_model_paths.yaml (requires COMFY_SUPERVISOR=true).
+#   • MODEL_CACHE_MIN_USES is how many jobs must use a model before it gets copied.
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "/model-cache")
+MODEL_CACHE_MAX_GB = float(os.environ.get("MODEL_CACHE_MAX_GB", 0))
+MODEL_CACHE_MIN_USES = int(os.environ.get("MODEL_CACHE_MIN_USES", 2))
+# Workflow input values ending with one of these are treated as model references
+MODEL_FILE_EXTENSIONS = (
+    ".safetensors", ".sft", ".ckpt", ".pt", ".pth", ".bin", ".gguf", ".onnx", ".pkl",
+)
+
+# Staging directory for outputs on their way to the bucket
+OUTPUT_STAGING_DIR = "/runpod-volume/tmp"
+# Content-addressed output deduplication (opt-in, also per job via the `dedup` flag)
+OUTPUT_DEDUP = os.environ.get("OUTPUT_DEDUP", "false").lower() == "true"
+OUTPUT_DEDUP_PREFIX = os.environ.get("OUTPUT_DEDUP_PREFIX", "rp/cas")
+
+# Background cleanup of ComfyUI output/temp and the staging directory (can be overridden)
+#   • OUTPUT_CLEANUP=true deletes a job's delivered outputs once all of its items were
+#     collected. Off by default: ComfyUI does not re-run cached output nodes, so an
+#     identical re-submitted job points at the same files and needs them to still exist.
+#   • Every JANITOR_INTERVAL_S the janitor removes staging files older than
+#     JANITOR_STAGING_MAX_AGE_S and output/temp files older than JANITOR_MAX_AGE_H,
+#     then deletes the oldest files until each directory fits JANITOR_MAX_GB (0 = no
+#     size quota). Files younger than JANITOR_GRACE_S are never swept.
+COMFY_OUTPUT_DIR = os.environ.get("COMFY_OUTPUT_DIR", os.path.join(COMFY_APP_DIR, "output"))
+COMFY_TEMP_DIR = os.environ.get("COMFY_TEMP_DIR", os.path.join(COMFY_APP_DIR, "temp"))
+OUTPUT_CLEANUP = os.environ.get("OUTPUT_CLEANUP", "false").lower() == "true"
+JANITOR_INTERVAL_S = float(os.environ.get("JANITOR_INTERVAL_S", 300))
+JANITOR_STAGING_MAX_AGE_S = float(os.environ.get("JANITOR_STAGING_MAX_AGE_S", 3600))
+JANITOR_MAX_AGE_H = float(os.environ.get("JANITOR_MAX_AGE_H", 24))
+JANITOR_MAX_GB = float(os.environ.get("JANITOR_MAX_GB", 10))
+JANITOR_GRACE_S = float(os.environ.get("JANITOR_GRACE_S", 600))
+
+# Multipart uploads for large outputs (can be overridden through environment variables)
+#   • Files of at least MULTIPART_THRESHOLD_MB go up as MULTIPART_PART_SIZE_MB parts,
+#     MULTIPART_CONCURRENCY at a time (keep <= 10, the boto3 connection pool size).
+#   • A failed part is retried MULTIPART_PART_RETRIES times on its own.
+MULTIPART_THRESHOLD_MB = float(os.environ.get("MULTIPART_THRESHOLD_MB", 64))
+MULTIPART_PART_SIZE_MB = float(os.environ.get("MULTIPART_PART_SIZE_MB", 16))
+MULTIPART_CONCURRENCY = int(os.environ.get("MULTIPART_CONCURRENCY", 4))
+MULTIPART_PART_RETRIES = int(os.environ.get("MULTIPART_PART_RETRIES", 3))
+
+# Remote input images (`images[].url` / `images[].key`) (can be overridden through environment variables)
+#   • Files are fetched INPUT_FETCH_CONCURRENCY at a time straight into COMFY_INPUT_DIR
+#     (or streamed through /upload/image when that directory is not local).
+#   • INPUT_CACHE_DIR keeps up to INPUT_CACHE_MAX_MB of recent downloads, revalidated by ETag.
+#   • A single file may not exceed INPUT_MAX_FILE_MB; all fetches of a job share
+#     INPUT_FETCH_BUDGET_S seconds.
+COMFY_INPUT_DIR = os.environ.get("COMFY_INPUT_DIR", os.path.join(COMFY_APP_DIR, "input"))
+INPUT_CACHE_DIR = os.environ.get("INPUT_CACHE_DIR", "/tmp/input-cache")
+INPUT_CACHE_MAX_MB = float(os.environ.get("INPUT_CACHE_MAX_MB", 2048))
+INPUT_MAX_FILE_MB = float(os.environ.get("INPUT_MAX_FILE_MB", 256))
+INPUT_FETCH_CONCURRENCY = int(os.environ.get("INPUT_FETCH_CONCURRENCY", 8))
+INPUT_FETCH_BUDGET_S = float(os.environ.get("INPUT_FETCH_BUDGET_S", 120))
+
+# Model residency policy between jobs (can be overridden through environment variables)
+#   • MEMORY_POLICY=false disables it.
+#   • MEMORY_RAM_HIGH / MEMORY_VRAM_HIGH are the used fractions counted as pressure.
+#   • MEMORY_UNLOAD_ON_SWITCH=true unloads models whenever the next job uses a different
+#     model family, even without memory pressure.
+#   • MEMORY_STATS_MAX_AGE_S: /system_stats cached by the health monitor is reused if fresher.
+MEMORY_POLICY_ENABLED = os.environ.get("MEMORY_POLICY", "true").lower() == "true"
+MEMORY_RAM_HIGH = float(os.environ.get("MEMORY_RAM_HIGH", 0.85))
+MEMORY_VRAM_HIGH = float(os.environ.get("MEMORY_VRAM_HIGH", 0.90))
+MEMORY_UNLOAD_ON_SWITCH = os.environ.get("MEMORY_UNLOAD_ON_SWITCH", "false").lower() == "true"
+MEMORY_STATS_MAX_AGE_S = float(os.environ.get("MEMORY_STATS_MAX_AGE_S", 2))
+
+# Maximum number of prompts a single batch job may enqueue
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 64))
+
+# Default per-job deadline in seconds (0 disables it). A job can override it through the
+# `timeout_s` input field. On expiry the job's prompt is interrupted/dequeued in ComfyUI.
+COMFY_JOB_TIMEOUT_S = float(os.environ.get("COMFY_JOB_TIMEOUT_S", 0))
+
+
+class ComfyUICrashedError(websocket.WebSocketConnectionClosedException):
+    """Raised when the ComfyUI process died while a job was waiting on it."""
+
+    def __init__(self, message, log_tail=None):
+        super().__init__(message)
+        self.log_tail = log_tail or []
+
+
+def _is_port_open(host_port, timeout=1.0):
+    """Return True if a TCP connection to ``host:port`` can be established."""
+    host, _, port = host_port.rpartition(":")
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class ComfyUISupervisor:
+    """
+    Runs ComfyUI as a child process of the handler and keeps it alive.
+
+    A background watcher thread spawns ``python main.py``, waits for the HTTP port,
+    flags the server as ready and blocks on the PID. When the process exits (crash,
+    OOM-kill, hang during startup) the exit is recorded together with the tail of the
+    log and ComfyUI is restarted with exponential backoff. Jobs use
+    :meth:`wait_until_ready` to ride out a restart instead of failing immediately.
+    """
+
+    def __init__(self, app_dir, log_path, extra_args=None, tail_lines=200):
+        self.app_dir = app_dir
+        self.log_path = log_path
+        self.extra_args = list(extra_args or [])
+        self.generation = 0
+        self.restart_count = 0
+        self.last_exit = None
+        self._proc = None
+        self._log_tail = collections.deque(maxlen=tail_lines)
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+        self._watch_thread = None
+
+    @property
+    def pid(self):
+        proc = self._proc
+        return proc.pid if proc else None
+
+    def is_alive(self):
+        proc = self._proc
+        return proc is not None and proc.poll() is None
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def log_tail(self, lines=50):
+        """Return the last ``lines`` lines ComfyUI wrote to stdout/stderr."""
+        tail = list(self._log_tail)
+        return tail[-lines:] if lines else tail
+
+    def start(self):
+        """Start the watcher thread, which launches ComfyUI and keeps restarting it."""
+        if self._watch_thread and self._watch_thread.is_alive():
+            return
+        self._stopping.clear()
+        self._watch_thread = threading.Thread(
+            target=self._watch, name="comfyui-supervisor", daemon=True
+        )
+        self._watch_thread.start()
+
+    def stop(self, timeout=10):
+        """Stop supervising and terminate the ComfyUI process."""
+        self._stopping.set()
+        self._ready.clear()
+        proc = self._proc
+        if proc is not None and proc.poll() is None:
+            print(f"worker-comfyui - Stopping ComfyUI (PID {proc.pid})...")
+            proc.terminate()
+            try:
+                proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def wait_until_ready(self, timeout):
+        """Block until ComfyUI accepts connections. Returns False on timeout."""
+        return self._ready.wait(timeout)
+
+    def wait_for_restart(self, generation, timeout):
+        """
+        Block until a process newer than ``generation`` accepts connections. Unlike
+        :meth:`wait_until_ready` this cannot return early on the stale ready flag of a
+        process that just died but was not reaped by the watcher yet.
+        """
+        deadline = time.time() + timeout
+        while not (self.generation > generation and self._ready.is_set() and self.is_alive()):
+            remaining = deadline - time.time()
+            if remaining <= 0 or self._stopping.is_set():
+                return False
+            time.sleep(min(0.2, remaining))
+        return True
+
+    def _spawn(self):
+        cmd = [sys.executable, "-u", "main.py", "--verbose"] + self.extra_args
+        print(f"worker-comfyui - Starting ComfyUI in {self.app_dir}: {' '.join(cmd)}")
+        proc = subprocess.Popen(
+            cmd,
+            cwd=self.app_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            bufsize=1,
+        )
+        self._proc = proc
+        self.generation += 1
+        threading.Thread(
+            target=self._pump_log, args=(proc,), name="comfyui-log", daemon=True
+        ).start()
+        print(f"worker-comfyui - ComfyUI PID: {proc.pid} (generation {self.generation})")
+        return proc
+
+    def _pump_log(self, proc):
+        # Mirror the child's output into the log file start.sh used to write and keep
+        # an in-memory tail for error reports. The pipe must be drained until EOF even
+        # if the log file breaks, otherwise ComfyUI blocks on its next print.
+        try:
+            log_file = open(self.log_path, "a", buffering=1)
+        except OSError as e:
+            print(f"worker-comfyui - Cannot open {self.log_path}, keeping only the log tail: {e}")
+            log_file = None
+        try:
+            for line in proc.stdout:
+                self._log_tail.append(line.rstrip("\n"))
+                if log_file is None:
+                    continue
+                try:
+                    log_file.write(line)
+                except OSError as e:
+                    print(f"worker-comfyui - Writing {self.log_path} failed, keeping only the log tail: {e}")
+                    try:
+                        log_file.close()
+                    except OSError:
+                        pass
+                    log_file = None
+        except Exception as e:
+            print(f"worker-comfyui - ComfyUI log pump stopped: {e}")
+        finally:
+            if log_file is not None:
+                try:
+                    log_file.close()
+                except OSError:
+                    pass
+
+    def _wait_for_port(self, proc, timeout_s):
+        deadline = time.time() + timeout_s
+        while time.time() < deadline and not self._stopping.is_set():
+            if proc.poll() is not None:
+                return False
+            if _is_port_open(COMFY_HOST):
+                return True
+            time.sleep(0.5)
+        return False
+
+    def _watch(self):
+        backoff = COMFY_RESTART_BACKOFF_S
+        while not self._stopping.is_set():
+            try:
+                proc = self._spawn()
+            except OSError as e:
+                print(f"worker-comfyui - Failed to launch ComfyUI: {e}")
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, COMFY_RESTART_BACKOFF_MAX_S)
+                continue
+
+            started_at = time.time()
+            if self._wait_for_port(proc, COMFY_STARTUP_TIMEOUT_S):
+                print(
+                    f"worker-comfyui - ComfyUI is ready on {COMFY_HOST} after {time.time() - started_at:.1f}s"
+                )
+                self._ready.set()
+            elif proc.poll() is None and not self._stopping.is_set():
+                print(
+                    f"worker-comfyui - ComfyUI did not open {COMFY_HOST} within {COMFY_STARTUP_TIMEOUT_S}s, killing it"
+                )
+                proc.kill()
+
+            returncode = proc.wait()
+            self._ready.clear()
+            if self._stopping.is_set():
+                break
+
+            uptime = time.time() - started_at
+            self.restart_count += 1
+            self.last_exit = {
+                "returncode": returncode,
+                "uptime_s": round(uptime, 1),
+                "time": time.time(),
+                "log_tail": self.log_tail(50),
+            }
+            print(
+                f"worker-comfyui - ComfyUI (PID {proc.pid}) exited with code {returncode} after {uptime:.1f}s"
+            )
+            print("worker-comfyui - Last ComfyUI log lines:")
+            for line in self.log_tail(30):
+                print(f"    {line}")
+
+            if uptime >= COMFY_RESTART_BACKOFF_RESET_S:
+                backoff = COMFY_RESTART_BACKOFF_S
+            print(
+                f"worker-comfyui - Restarting ComfyUI in {backoff:.1f}s (restart #{self.restart_count})"
+            )
+            self._stopping.wait(backoff)
+            backoff = min(backoff * 2, COMFY_RESTART_BACKOFF_MAX_S)
+
+
+# Created in __main__ when COMFY_SUPERVISOR=true; None when ComfyUI is managed externally
+COMFY_SUPERVISOR = None
+
+
+def _comfy_crashed():
+    """Return True if the supervised ComfyUI process is down or being restarted."""
+    return COMFY_SUPERVISOR is not None and not (
+        COMFY_SUPERVISOR.is_alive() and COMFY_SUPERVISOR.is_ready()
+    )
+
+
+def _raise_comfy_crashed(context):
+    """Raise ComfyUICrashedError enriched with the supervisor's exit info and log tail."""
+    last_exit = COMFY_SUPERVISOR.last_exit if COMFY_SUPERVISOR else None
+    message = f"ComfyUI process died {context}"
+    if last_exit:
+        message += f" (exit code {last_exit['returncode']})"
+    log_tail = COMFY_SUPERVISOR.log_tail(50) if COMFY_SUPERVISOR else []
+    raise ComfyUICrashedError(message, log_tail)
+
 # ---------------------------------------------------------------------------
 # Helper: quick reachability probe of ComfyUI HTTP endpoint (port 8188)
 # ---------------------------------------------------------------------------
@@ -58,6 +436,163 @@ def _comfy_server_status():
         return {"reachable": False, "error": str(exc)}
 
 
+# Background health monitoring (can be overridden through environment variables)
+#   • COMFY_HEALTH_INTERVAL_S sets how often the cheap probe runs.
+#   • COMFY_HEALTH_PROBE_TIMEOUT_S bounds the HTTP probe; a timeout on an open port
+#     means the aiohttp event loop inside ComfyUI is hung.
+#   • COMFY_HEALTH_FAILURE_THRESHOLD consecutive failures flip the state to unhealthy.
+#   • COMFY_HEALTH_HEARTBEAT_FRESH_S: a websocket message received this recently counts
+#     as a successful probe, so busy workers don't poll HTTP at all.
+COMFY_HEALTH_INTERVAL_S = float(os.environ.get("COMFY_HEALTH_INTERVAL_S", 5))
+COMFY_HEALTH_PROBE_TIMEOUT_S = float(os.environ.get("COMFY_HEALTH_PROBE_TIMEOUT_S", 3))
+COMFY_HEALTH_FAILURE_THRESHOLD = int(os.environ.get("COMFY_HEALTH_FAILURE_THRESHOLD", 2))
+COMFY_HEALTH_HEARTBEAT_FRESH_S = float(os.environ.get("COMFY_HEALTH_HEARTBEAT_FRESH_S", 10))
+
+# Human readable explanations for the health monitor's failure reasons
+COMFY_HEALTH_REASONS = {
+    "not_probed": "health of ComfyUI has not been probed yet",
+    "process_dead": "ComfyUI process is not running",
+    "port_closed": f"nothing is listening on {COMFY_HOST}",
+    "event_loop_hung": f"{COMFY_HOST} accepts connections but ComfyUI does not answer HTTP requests (event loop hung)",
+    "http_error": "ComfyUI answered the health probe with an HTTP error",
+}
+
+
+class ComfyUIHealthMonitor:
+    """
+    Keeps a cached readiness flag for ComfyUI up to date in the background.
+
+    The state is fed by websocket traffic of running jobs (:meth:`note_heartbeat`) and
+    by a periodic probe that escalates from cheap to less cheap: supervisor PID check,
+    TCP connect to the port and finally a ``GET /system_stats`` with a short timeout.
+    :meth:`status` only reads the cached values, so the job path never blocks on it.
+    """
+
+    def __init__(
+        self,
+        supervisor=None,
+        interval_s=COMFY_HEALTH_INTERVAL_S,
+        probe_timeout_s=COMFY_HEALTH_PROBE_TIMEOUT_S,
+        failure_threshold=COMFY_HEALTH_FAILURE_THRESHOLD,
+    ):
+        self.supervisor = supervisor
+        self.interval_s = interval_s
+        self.probe_timeout_s = probe_timeout_s
+        self.failure_threshold = failure_threshold
+        self.healthy = False
+        self.reason = "not_probed"
+        self.last_probe = None
+        self.last_heartbeat = 0.0
+        self.consecutive_failures = 0
+        # Last /system_stats payload, reused by the memory residency policy
+        self.system_stats = None
+        self.system_stats_time = 0.0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="comfyui-health", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def status(self):
+        """Return the cached ``(healthy, reason)`` tuple without any I/O."""
+        return self.healthy, self.reason
+
+    def snapshot(self):
+        """Return the cached health state as a JSON-serialisable dict."""
+        with self._lock:
+            return {
+                "healthy": self.healthy,
+                "reason": self.reason,
+                "last_probe": self.last_probe,
+                "last_heartbeat": self.last_heartbeat or None,
+                "consecutive_failures": self.consecutive_failures,
+            }
+
+    def note_heartbeat(self):
+        """Record websocket traffic from ComfyUI – proof that its event loop is alive."""
+        self.last_heartbeat = time.time()
+        if not self.healthy:
+            self._record(None)
+
+    def probe_now(self):
+        """Run a full probe synchronously and update the cached state."""
+        self._record(self._probe())
+        return self.status()
+
+    def _probe(self, full=True):
+        """Return None if ComfyUI looks healthy, otherwise a failure reason key."""
+        if self.supervisor is not None and not self.supervisor.is_alive():
+            return "process_dead"
+        if not full:
+            return None
+        if not _is_port_open(COMFY_HOST, timeout=1.0):
+            return "port_closed"
+        try:
+            response = requests.get(
+                f"http://{COMFY_HOST}/system_stats", timeout=self.probe_timeout_s
+            )
+        except requests.Timeout:
+            return "event_loop_hung"
+        except requests.RequestException:
+            return "port_closed"
+        if response.status_code != 200:
+            return "http_error"
+        try:
+            self.system_stats = response.json()
+            self.system_stats_time = time.time()
+        except ValueError:
+            pass
+        return None
+
+    def _record(self, failure):
+        with self._lock:
+            self.last_probe = time.time()
+            was_healthy = self.healthy
+            if failure is None:
+                self.consecutive_failures = 0
+                self.healthy = True
+                self.reason = "ok"
+            else:
+                self.consecutive_failures += 1
+                # A dead process is unambiguous; everything else needs confirmation
+                if (
+                    failure == "process_dead"
+                    or self.consecutive_failures >= self.failure_threshold
+                    or not was_healthy
+                ):
+                    self.healthy = False
+                    self.reason = failure
+        if was_healthy != self.healthy:
+            state = "healthy" if self.healthy else f"UNHEALTHY ({self.reason})"
+            print(f"worker-comfyui - ComfyUI health changed: {state}")
+
+    def _run(self):
+        while not self._stopping.wait(self.interval_s):
+            try:
+                # Recent websocket traffic already proves the server is responsive;
+                # only the (free) PID check is still worth doing in that case.
+                heartbeat_fresh = (
+                    time.time() - self.last_heartbeat < COMFY_HEALTH_HEARTBEAT_FRESH_S
+                )
+                self._record(self._probe(full=not heartbeat_fresh))
+            except Exception as e:
+                print(f"worker-comfyui - Health probe failed unexpectedly: {e}")
+
+
+# Created in __main__; None when the module is imported without a running worker
+COMFY_HEALTH = None
+
+
 def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
     """
     Attempts to reconnect to the WebSocket server after a disconnect.
@@ -85,6 +620,13 @@ def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
         # between a network glitch and an outright ComfyUI crash/OOM-kill.
         srv_status = _comfy_server_status()
         if not srv_status["reachable"]:
+            if _comfy_crashed():
+                # The supervisor saw the process go away – report it as a crash so the
+                # handler can wait for the restart (and optionally resubmit the job).
+                print(
+                    "worker-comfyui - ComfyUI process is down – aborting websocket reconnect"
+                )
+                _raise_comfy_crashed("during websocket reconnect")
             # If ComfyUI itself is down there is no point in retrying the websocket –
             # bail out immediately so the caller gets a clear "ComfyUI crashed" error.
             print(
@@ -129,6 +671,843 @@ def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
     )
 
 
+def _validate_workflow_graph(workflow):
+    """Return an error message if ``workflow`` is not a ComfyUI API-format prompt, else None."""
+    if not isinstance(workflow, dict) or not workflow:
+        return "workflow must be a non-empty object keyed by node id"
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or "class_type" not in node:
+            return f"node '{node_id}' has no 'class_type'"
+        if not isinstance(node.get("inputs", {}), dict):
+            return f"node '{node_id}' has non-object 'inputs'"
+    return None
+
+
+class WorkflowTemplateRegistry:
+    """
+    Named workflow templates loaded from ``<template_id>.json`` files on the volume.
+
+    Templates are parsed and validated once and then shared by all jobs; jobs only
+    send the template id and a small override map (see :func:`apply_overrides`, which
+    never mutates the shared template). Changes on disk are picked up by comparing
+    mtime/size of the files at most every ``rescan_s`` seconds, so lookups stay cheap.
+    A template file may contain the API-format workflow itself or ``{"workflow": {...}}``.
+    """
+
+    def __init__(self, directory, rescan_s=WORKFLOW_TEMPLATES_RESCAN_S):
+        self.directory = directory
+        self.rescan_s = rescan_s
+        self._templates = {}
+        self._errors = {}
+        self._signatures = {}
+        self._last_scan = 0.0
+        self._lock = threading.Lock()
+
+    def ids(self):
+        self._maybe_refresh()
+        return sorted(self._templates)
+
+    def get(self, template_id):
+        """
+        Look up a template.
+
+        Returns:
+            tuple: ``(workflow, error_message)``; the workflow must not be mutated.
+        """
+        self._maybe_refresh()
+        entry = self._templates.get(template_id)
+        if entry is not None:
+            return entry["workflow"], None
+        if template_id in self._errors:
+            return None, f"Template '{template_id}' is invalid: {self._errors[template_id]}"
+        available = ", ".join(sorted(self._templates)) or "none"
+        return None, f"Unknown template '{template_id}' (available: {available})"
+
+    def _maybe_refresh(self):
+        if time.time() - self._last_scan < self.rescan_s:
+            return
+        with self._lock:
+            if time.time() - self._last_scan >= self.rescan_s:
+                self.refresh()
+
+    def refresh(self):
+        """Reload templates whose files were added, changed or removed."""
+        self._last_scan = time.time()
+        seen = set()
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            entries = []
+
+        for entry in entries:
+            if not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            template_id = entry.name[: -len(".json")]
+            seen.add(template_id)
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if self._signatures.get(template_id) != signature:
+                self._signatures[template_id] = signature
+                self._load(template_id, entry.path)
+
+        for template_id in set(self._signatures) - seen:
+            if self._templates.pop(template_id, None) is not None:
+                print(f"worker-comfyui - Workflow template '{template_id}' removed")
+            self._errors.pop(template_id, None)
+            del self._signatures[template_id]
+
+    def _load(self, template_id, path):
+        try:
+            with open(path, "r") as f:
+                raw = json.load(f)
+            workflow = raw.get("workflow", raw) if isinstance(raw, dict) else raw
+            error = _validate_workflow_graph(workflow)
+        except (OSError, json.JSONDecodeError) as e:
+            workflow, error = None, str(e)
+
+        if error:
+            print(f"worker-comfyui - Skipping invalid workflow template '{template_id}': {error}")
+            self._templates.pop(template_id, None)
+            self._errors[template_id] = error
+            return
+
+        self._errors.pop(template_id, None)
+        self._templates[template_id] = {"workflow": workflow}
+        print(f"worker-comfyui - Loaded workflow template '{template_id}' ({len(workflow)} nodes)")
+
+
+WORKFLOW_TEMPLATES = WorkflowTemplateRegistry(WORKFLOW_TEMPLATES_DIR)
+
+
+class ModelInventory:
+    """
+    Index of the files in the models directory, grouped by category (top-level folder).
+
+    The index is refreshed incrementally: a directory is only listed again when its
+    mtime changed (which happens whenever a file is added, removed or renamed in it),
+    unchanged directories cost a single ``stat``. An in-place overwrite does not touch
+    the directory mtime, so :meth:`resolve` re-stats the files a job references.
+    Entries carry size, mtime and – with
+    MODEL_INDEX_HASH – a sha256 that is computed in the background and persisted.
+    Names use the same ``subfolder/file.safetensors`` form ComfyUI uses in workflows.
+    """
+
+    def __init__(self, root, refresh_s=MODEL_INDEX_REFRESH_S, hash_files=False, cache_path=None):
+        self.root = root
+        self.refresh_s = refresh_s
+        self.hash_files = hash_files
+        self.cache_path = cache_path
+        self.last_refresh = None
+        self._dir_mtimes = {}
+        self._dir_files = {}
+        self._dir_subdirs = {}
+        self._hashes = {}
+        self._by_name = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def available(self):
+        """True once the models directory was found and indexed."""
+        return self.root in self._dir_mtimes
+
+    def start(self):
+        self._load_hash_cache()
+        self.refresh()
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="model-inventory", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def refresh(self):
+        """Rescan directories whose mtime changed since the previous refresh."""
+        started = time.time()
+        with self._lock:
+            rescanned = self._scan_dir(self.root, set())
+            if rescanned:
+                self._rebuild_names()
+            self.last_refresh = time.time()
+        if rescanned:
+            print(
+                f"worker-comfyui - Model index: rescanned {rescanned} dir(s), "
+                f"{len(self._by_name)} model(s) indexed in {time.time() - started:.2f}s"
+            )
+
+    def _scan_dir(self, path, visited):
+        try:
+            stat = os.stat(path)
+            real = os.path.realpath(path)
+        except OSError:
+            self._forget_dir(path)
+            return 0
+        if real in visited:
+            # Symlink loop
+            return 0
+        visited.add(real)
+
+        rescanned = 0
+        if self._dir_mtimes.get(path) != stat.st_mtime_ns:
+            files, subdirs = {}, []
+            try:
+                for entry in os.scandir(path):
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            subdirs.append(entry.path)
+                        elif entry.is_file():
+                            entry_stat = entry.stat()
+                            files[entry.name] = (entry_stat.st_size, entry_stat.st_mtime)
+                    except OSError:
+                        continue
+            except OSError as e:
+                print(f"worker-comfyui - Model index: cannot list {path}: {e}")
+                return 0
+            for gone in set(self._dir_subdirs.get(path, [])) - set(subdirs):
+                self._forget_dir(gone)
+            self._dir_mtimes[path] = stat.st_mtime_ns
+            self._dir_files[path] = files
+            self._dir_subdirs[path] = subdirs
+            rescanned += 1
+
+        for subdir in self._dir_subdirs.get(path, []):
+            rescanned += self._scan_dir(subdir, visited)
+        return rescanned
+
+    @staticmethod
+    def _stat_file(path):
+        """Return ``(size, mtime)`` of a file, or None if it is gone."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def _forget_dir(self, path):
+        for subdir in self._dir_subdirs.pop(path, []):
+            self._forget_dir(subdir)
+        self._dir_mtimes.pop(path, None)
+        self._dir_files.pop(path, None)
+
+    def _iter_files(self):
+        """Yield ``(category, name, abs_path, size, mtime)`` for every indexed file."""
+        for dir_path, files in self._dir_files.items():
+            rel_dir = os.path.relpath(dir_path, self.root)
+            if rel_dir == ".":
+                continue
+            parts = rel_dir.replace(os.sep, "/").split("/")
+            category, prefix = parts[0], "/".join(parts[1:])
+            for filename, info in files.items():
+                if info is None:
+                    continue
+                size, mtime = info
+                name = f"{prefix}/{filename}" if prefix else filename
+                yield category, name, os.path.join(dir_path, filename), size, mtime
+
+    def _rebuild_names(self):
+        by_name = {}
+        for category, name, _, _, _ in self._iter_files():
+            by_name.setdefault(name, set()).add(category)
+        self._by_name = by_name
+
+    def has_model(self, name, categories=None):
+        found = self._by_name.get(name.replace("\\", "/"))
+        if not found:
+            return False
+        return categories is None or bool(found.intersection(categories))
+
+    def resolve(self, name):
+        """Return ``[(category, abs_path, size, mtime)]`` for every copy of a model name."""
+        name = name.replace("\\", "/")
+        result = []
+        with self._lock:
+            for category in sorted(self._by_name.get(name, ())):
+                path = os.path.join(self.root, category, *name.split("/"))
+                files = self._dir_files.get(os.path.dirname(path), {})
+                if os.path.basename(path) not in files:
+                    continue
+                # Re-stat: the file may have been overwritten since the last refresh
+                info = self._stat_file(path)
+                files[os.path.basename(path)] = info
+                if info:
+                    result.append((category, path, info[0], info[1]))
+        return result
+
+    def names_by_category(self):
+        """Return ``{category: [model names]}``."""
+        with self._lock:
+            result = {}
+            for category, name, _, _, _ in self._iter_files():
+                result.setdefault(category, []).append(name)
+        return {category: sorted(names) for category, names in result.items()}
+
+    def snapshot(self):
+        """Return the full index as ``{category: {name: {size, mtime[, sha256]}}}``."""
+        with self._lock:
+            result = {}
+            for category, name, path, size, mtime in self._iter_files():
+                entry = {"size": size, "mtime": mtime}
+                cached = self._hashes.get(path)
+                if cached and cached["size"] == size and cached["mtime"] == mtime:
+                    entry["sha256"] = cached["sha256"]
+                result.setdefault(category, {})[name] = entry
+        return result
+
+    def missing_models(self, workflows):
+        """
+        Return a list of problems for model files that core loaders in ``workflows``
+        reference but that are not in the folders ComfyUI resolves them from. Names
+        missing from the index are checked on disk, so files copied since the last
+        refresh count without rescanning the volume on the job path.
+        """
+        references = [
+            reference
+            for workflow in workflows
+            for reference in find_core_model_references(workflow)
+        ]
+        if not references or not self.available:
+            return []
+        missing = []
+        for node_id, input_name, value, folders in references:
+            if not self.has_model(value, folders) and not any(
+                os.path.isfile(os.path.join(self.root, folder, *value.replace("\\", "/").split("/")))
+                for folder in folders
+            ):
+                missing.append(
+                    f"Node {node_id} ({input_name}): model '{value}' not found in {'/'.join(folders)}"
+                )
+        return sorted(set(missing))
+
+    def _load_hash_cache(self):
+        if not self.hash_files or not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, "r") as f:
+                self._hashes = json.load(f)
+        except (OSError, ValueError):
+            self._hashes = {}
+
+    def _save_hash_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._hashes, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"worker-comfyui - Model index: could not save hash cache: {e}")
+
+    def _hash_pending_files(self):
+        with self._lock:
+            todo = [
+                (path, size, mtime)
+                for _, _, path, size, mtime in self._iter_files()
+                if not (
+                    path in self._hashes
+                    and self._hashes[path]["size"] == size
+                    and self._hashes[path]["mtime"] == mtime
+                )
+            ]
+        for path, size, mtime in todo:
+            if self._stopping.is_set():
+                return
+            digest = hashlib.sha256()
+            try:
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                        digest.update(chunk)
+            except OSError:
+                continue
+            self._hashes[path] = {"size": size, "mtime": mtime, "sha256": digest.hexdigest()}
+            self._save_hash_cache()
+
+    def _run(self):
+        while True:
+            if self.hash_files:
+                self._hash_pending_files()
+            if self._stopping.wait(self.refresh_s):
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"worker-comfyui - Model index refresh failed: {e}")
+
+
+# Created in __main__; None when the module is imported without a running worker
+MODEL_INVENTORY = None
+
+
+class ModelCache:
+    """
+    Local-disk tier for frequently used model files in front of the network volume.
+
+    Every job reports the models it references (:meth:`record_workflows`). A model that
+    was used ``min_uses`` times is copied in the background to ``cache_dir`` under the
+    same ``<category>/<name>`` layout, so ComfyUI resolves the same name to the local
+    file once the generated extra_model_paths.yaml puts the cache ahead of the volume.
+    Files are evicted least-recently-used first to stay within ``budget_bytes``, stale
+    copies (size/mtime differ from the volume) are dropped, and per-model use/hit/miss
+    counters are persisted next to the cached files.
+    """
+
+    STATE_FILE = "cache_state.json"
+
+    def __init__(self, cache_dir, budget_bytes, inventory, min_uses=MODEL_CACHE_MIN_USES):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self.inventory = inventory
+        self.min_uses = min_uses
+        self.stats = {}
+        # key ("category/name") -> size, ordered from least to most recently used
+        self._cached = collections.OrderedDict()
+        self._queued = set()
+        self._copy_queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def used_bytes(self):
+        return sum(self._cached.values())
+
+    def _local_path(self, key):
+        return os.path.join(self.cache_dir, *key.split("/"))
+
+    def start(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_state()
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="model-cache", daemon=True
+        )
+        self._thread.start()
+
+    def write_extra_model_paths(self, categories):
+        """
+        Write an extra_model_paths.yaml that registers the cache for ``categories`` as
+        the default (first searched) location and return its path.
+        """
+        lines = [
+            "# Generated by handler.py – local model cache in front of the network volume",
+            "local_model_cache:",
+            f"    base_path: {self.cache_dir}",
+            "    is_default: true",
+        ]
+        for category in sorted(categories):
+            lines.append(f"    {category}: {category}")
+            os.makedirs(os.path.join(self.cache_dir, category), exist_ok=True)
+        config_path = os.path.join(self.cache_dir, "extra_model_paths.yaml")
+        with open(config_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return config_path
+
+    def record_workflows(self, workflows):
+        """Count a use of every model referenced by ``workflows`` (once per job)."""
+        keys_seen = set()
+        for workflow in workflows:
+            for _, _, value in find_model_references(workflow):
+                for category, source, _, _ in self.inventory.resolve(value)[:1]:
+                    key = f"{category}/{value}".replace("\\", "/")
+                    if key not in keys_seen:
+                        keys_seen.add(key)
+                        self.record_use(key, source)
+        if keys_seen:
+            self._save_state()
+
+    def record_use(self, key, source):
+        """Record a use of a model and schedule its copy once it's hot. Returns True on a hit."""
+        local = self._local_path(key)
+        # Stat the volume copy itself: a model overwritten in place must not keep
+        # being served from a stale local copy
+        try:
+            source_stat = os.stat(source)
+        except OSError:
+            source_stat = None
+        with self._lock:
+            if source_stat is None:
+                if key in self._cached:
+                    self._remove(key)
+                return False
+            size, mtime = source_stat.st_size, source_stat.st_mtime
+            stat = self.stats.setdefault(key, {"uses": 0, "hits": 0, "misses": 0})
+            stat["uses"] += 1
+            stat["last_used"] = time.time()
+            hit = key in self._cached and self._is_fresh(local, size, mtime)
+            if hit:
+                stat["hits"] += 1
+                self._cached.move_to_end(key)
+                return True
+
+            stat["misses"] += 1
+            if key in self._cached:
+                print(f"worker-comfyui - Model cache: dropping stale copy of {key}")
+                self._remove(key)
+            if (
+                stat["uses"] >= self.min_uses
+                and key not in self._queued
+                and size <= self.budget_bytes
+            ):
+                self._queued.add(key)
+                self._copy_queue.put((key, source, size))
+        return False
+
+    @staticmethod
+    def _is_fresh(local, size, mtime):
+        try:
+            stat = os.stat(local)
+        except OSError:
+            return False
+        return stat.st_size == size and int(stat.st_mtime) == int(mtime)
+
+    def _remove(self, key):
+        self._cached.pop(key, None)
+        try:
+            os.remove(self._local_path(key))
+        except OSError:
+            pass
+
+    def _copy(self, key, source, size):
+        local = self._local_path(key)
+        with self._lock:
+            while self._cached and self.used_bytes + size > self.budget_bytes:
+                evicted, evicted_size = next(iter(self._cached.items()))
+                print(
+                    f"worker-comfyui - Model cache: evicting {evicted} ({evicted_size / 1e9:.2f} GB)"
+                )
+                self._remove(evicted)
+
+        started = time.time()
+        partial = f"{local}.partial"
+        try:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            with open(source, "rb") as src, open(partial, "wb") as dst:
+                shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+            shutil.copystat(source, partial)
+            os.replace(partial, local)
+        except OSError as e:
+            print(f"worker-comfyui - Model cache: failed to copy {key}: {e}")
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._cached[key] = size
+        elapsed = time.time() - started
+        print(
+            f"worker-comfyui - Model cache: cached {key} ({size / 1e9:.2f} GB in {elapsed:.1f}s, "
+            f"{self.used_bytes / 1e9:.2f}/{self.budget_bytes / 1e9:.2f} GB used)"
+        )
+        self._save_state()
+
+    def _run(self):
+        while True:
+            key, source, size = self._copy_queue.get()
+            try:
+                self._copy(key, source, size)
+            except Exception as e:
+                print(f"worker-comfyui - Model cache: unexpected error caching {key}: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(key)
+
+    def _load_state(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.STATE_FILE), "r") as f:
+                self.stats = json.load(f)
+        except (OSError, ValueError):
+            self.stats = {}
+
+        # Re-adopt files copied before a restart, oldest use first
+        found = []
+        for dir_path, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                if filename.endswith(".partial"):
+                    os.remove(path)
+                    continue
+                key = os.path.relpath(path, self.cache_dir).replace(os.sep, "/")
+                if "/" not in key:
+                    continue
+                last_used = self.stats.get(key, {}).get("last_used", 0)
+                found.append((last_used, key, os.path.getsize(path)))
+        for _, key, size in sorted(found):
+            self._cached[key] = size
+
+    def _save_state(self):
+        with self._lock:
+            data = json.dumps(self.stats)
+        try:
+            tmp_path = os.path.join(self.cache_dir, f"{self.STATE_FILE}.tmp")
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.cache_dir, self.STATE_FILE))
+        except OSError as e:
+            print(f"worker-comfyui - Model cache: could not save state: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            models = {
+                key: dict(stat, cached=key in self._cached)
+                for key, stat in self.stats.items()
+            }
+            return {
+                "dir": self.cache_dir,
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": self.used_bytes,
+                "models": models,
+            }
+
+
+# Created in __main__ when MODEL_CACHE_MAX_GB > 0
+MODEL_CACHE = None
+
+
+def find_model_references(workflow):
+    """Yield ``(node_id, input_name, value)`` for workflow inputs that name a model file."""
+    for node_id, node in workflow.items():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        if not isinstance(inputs, dict):
+            continue
+        for input_name, value in inputs.items():
+            if isinstance(value, str) and value.lower().endswith(MODEL_FILE_EXTENSIONS):
+                yield node_id, input_name, value
+
+
+# Core ComfyUI loaders: class_type -> {input_name: model folders it is resolved from}.
+# Custom nodes often read weights from their own folders, so only these are enforced.
+_CHECKPOINTS = ("checkpoints",)
+_DIFFUSION_MODELS = ("diffusion_models", "unet")
+_TEXT_ENCODERS = ("text_encoders", "clip")
+_LORAS = ("loras",)
+CORE_MODEL_LOADERS = {
+    "CheckpointLoaderSimple": {"ckpt_name": _CHECKPOINTS},
+    "CheckpointLoader": {"ckpt_name": _CHECKPOINTS},
+    "ImageOnlyCheckpointLoader": {"ckpt_name": _CHECKPOINTS},
+    "unCLIPCheckpointLoader": {"ckpt_name": _CHECKPOINTS},
+    "UNETLoader": {"unet_name": _DIFFUSION_MODELS},
+    "VAELoader": {"vae_name": ("vae",)},
+    "LoraLoader": {"lora_name": _LORAS},
+    "LoraLoaderModelOnly": {"lora_name": _LORAS},
+    "CLIPLoader": {"clip_name": _TEXT_ENCODERS},
+    "DualCLIPLoader": {f"clip_name{i}": _TEXT_ENCODERS for i in (1, 2)},
+    "TripleCLIPLoader": {f"clip_name{i}": _TEXT_ENCODERS for i in (1, 2, 3)},
+    "QuadrupleCLIPLoader": {f"clip_name{i}": _TEXT_ENCODERS for i in (1, 2, 3, 4)},
+    "CLIPVisionLoader": {"clip_name": ("clip_vision",)},
+    "ControlNetLoader": {"control_net_name": ("controlnet",)},
+    "DiffControlNetLoader": {"control_net_name": ("controlnet",)},
+    "UpscaleModelLoader": {"model_name": ("upscale_models",)},
+    "StyleModelLoader": {"style_model_name": ("style_models",)},
+    "GLIGENLoader": {"gligen_name": ("gligen",)},
+    "HypernetworkLoader": {"hypernetwork_name": ("hypernetworks",)},
+    "PhotoMakerLoader": {"photomaker_model_name": ("photomaker",)},
+}
+
+
+def find_core_model_references(workflow):
+    """
+    Yield ``(node_id, input_name, value, folders)`` for model inputs of the core
+    ComfyUI loaders, where ``folders`` are the model folders ComfyUI searches.
+    """
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            continue
+        loader_inputs = CORE_MODEL_LOADERS.get(node.get("class_type"))
+        inputs = node.get("inputs")
+        if not loader_inputs or not isinstance(inputs, dict):
+            continue
+        for input_name, folders in loader_inputs.items():
+            value = inputs.get(input_name)
+            if isinstance(value, str) and value.lower().endswith(MODEL_FILE_EXTENSIONS):
+                yield node_id, input_name, value, folders
+
+
+# Model folders whose models dominate memory; a change of these is a family switch
+_HEAVY_MODEL_FOLDERS = frozenset(_CHECKPOINTS + _DIFFUSION_MODELS + _TEXT_ENCODERS)
+
+
+class ModelResidencyPolicy:
+    """
+    Decides between jobs whether ComfyUI should drop models or cached data.
+
+    ComfyUI's ``/free`` endpoint takes two flags: ``unload_models`` drops every loaded
+    model and ``free_memory`` additionally drops the execution cache. ComfyUI only
+    stores truthy flags and its prompt worker unloads models whenever ``free_memory``
+    is set, so every ``/free`` call is a full unload. The policy remembers the heavy
+    models (checkpoint, unet, text encoder) ComfyUI may hold since the last unload or
+    restart and compares host RAM / VRAM usage from ``/system_stats`` against the
+    thresholds:
+
+    * The next job needs a different model family and VRAM or RAM is under pressure
+      (or MEMORY_UNLOAD_ON_SWITCH is set) → ``unload_models``, plus ``free_memory``
+      under RAM pressure.
+    * Same family → nothing, even under pressure: freeing anything would unload the
+      models the job is about to use.
+    """
+
+    def __init__(
+        self,
+        host=COMFY_HOST,
+        ram_high=MEMORY_RAM_HIGH,
+        vram_high=MEMORY_VRAM_HIGH,
+        unload_on_switch=MEMORY_UNLOAD_ON_SWITCH,
+        history=20,
+    ):
+        self.host = host
+        self.ram_high = ram_high
+        self.vram_high = vram_high
+        self.unload_on_switch = unload_on_switch
+        self.resident = set()
+        self.generation = None
+        self.recent = collections.deque(maxlen=history)
+        self.last_action = None
+
+    @staticmethod
+    def heavy_models(workflows):
+        return {
+            value
+            for workflow in workflows
+            for _, _, value, folders in find_core_model_references(workflow)
+            if _HEAVY_MODEL_FOLDERS.intersection(folders)
+        }
+
+    @staticmethod
+    def memory_usage(system_stats):
+        """Return ``(ram_used_fraction, vram_used_fraction)``; None where unknown."""
+        system = system_stats.get("system", {})
+        ram_used = None
+        if system.get("ram_total"):
+            ram_used = 1 - system.get("ram_free", 0) / system["ram_total"]
+        vram_used = None
+        for device in system_stats.get("devices", []):
+            if device.get("type") == "cpu" or not device.get("vram_total"):
+                continue
+            used = 1 - device.get("vram_free", 0) / device["vram_total"]
+            vram_used = used if vram_used is None else max(vram_used, used)
+        return ram_used, vram_used
+
+    def decide(self, system_stats, next_models):
+        """
+        Return ``(free_payload, reason)`` for the next job; ``free_payload`` is None
+        when nothing needs to be freed.
+        """
+        ram_used, vram_used = self.memory_usage(system_stats or {})
+        ram_pressure = ram_used is not None and ram_used >= self.ram_high
+        vram_pressure = vram_used is not None and vram_used >= self.vram_high
+        switching = bool(self.resident and next_models and not (next_models & self.resident))
+
+        if not (switching and (ram_pressure or vram_pressure or self.unload_on_switch)):
+            return None, None
+
+        payload = {"unload_models": True}
+        reasons = []
+        if ram_pressure:
+            payload["free_memory"] = True
+            reasons.append(f"RAM {ram_used:.0%} used")
+        if vram_pressure:
+            reasons.append(f"VRAM {vram_used:.0%} used")
+        reasons.append(
+            f"switching from {', '.join(sorted(self.resident))} to {', '.join(sorted(next_models))}"
+        )
+        return payload, "; ".join(reasons)
+
+    def _system_stats(self):
+        if (
+            COMFY_HEALTH is not None
+            and COMFY_HEALTH.system_stats is not None
+            and time.time() - COMFY_HEALTH.system_stats_time <= MEMORY_STATS_MAX_AGE_S
+        ):
+            return COMFY_HEALTH.system_stats
+        response = requests.get(f"http://{self.host}/system_stats", timeout=5)
+        response.raise_for_status()
+        return response.json()
+
+    def before_job(self, workflows, generation=None):
+        """
+        Apply the policy for the job about to be queued. ``generation`` identifies the
+        ComfyUI process; a restart starts with nothing loaded. Returns the /free
+        payload sent.
+        """
+        if generation != self.generation:
+            self.resident.clear()
+            self.generation = generation
+        next_models = self.heavy_models(workflows)
+        try:
+            payload, reason = self.decide(self._system_stats(), next_models)
+            if payload:
+                print(f"worker-comfyui - Memory policy: /free {payload} ({reason})")
+                requests.post(
+                    f"http://{self.host}/free", json=payload, timeout=5
+                ).raise_for_status()
+                self.last_action = {"time": time.time(), "payload": payload, "reason": reason}
+        except (requests.RequestException, ValueError) as e:
+            print(f"worker-comfyui - Memory policy skipped: {e}")
+            payload = None
+
+        if payload:
+            # Any /free unloads everything; only the next job's models will be loaded
+            self.resident = set(next_models)
+        else:
+            self.resident |= next_models
+        self.recent.append(sorted(next_models))
+        return payload
+
+    def snapshot(self):
+        return {
+            "resident": sorted(self.resident),
+            "recent": list(self.recent),
+            "last_action": self.last_action,
+        }
+
+
+# Created in __main__ unless MEMORY_POLICY=false
+MEMORY_POLICY = None
+
+
+def apply_overrides(workflow, overrides):
+    """
+    Return a copy of ``workflow`` with node inputs replaced by ``overrides``.
+
+    Only the touched nodes and their ``inputs`` dicts are copied; every other node is
+    shared with the original workflow, which must therefore not be mutated afterwards.
+
+    Args:
+        workflow (dict): The ComfyUI prompt (API format) keyed by node id.
+        overrides (dict): ``{node_id: {input_name: value}}``.
+
+    Returns:
+        tuple: ``(patched_workflow, error_message)``.
+    """
+    if not isinstance(overrides, dict):
+        return None, "overrides must be an object of {node_id: {input_name: value}}"
+
+    patched = dict(workflow)
+    for node_id, inputs in overrides.items():
+        node_id = str(node_id)
+        node = workflow.get(node_id)
+        if not isinstance(node, dict):
+            return None, f"node '{node_id}' does not exist in the workflow"
+        if not isinstance(inputs, dict):
+            return None, f"overrides for node '{node_id}' must be an object"
+        node = dict(node)
+        node["inputs"] = {**node.get("inputs", {}), **inputs}
+        patched[node_id] = node
+    return patched, None
+
+
 def validate_input(job_input):
     """
     Validates the input for the handler function.
@@ -151,24 +1530,95 @@ def validate_input(job_input):
         except json.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
-    # Validate 'workflow' in input
+    # Validate 'workflow' / 'template' / 'batch' in input. A template is a workflow stored
+    # on the volume and referenced by id. A batch is either a list of workflows or one
+    # workflow/template plus a list of per-item overrides ({node_id: {input_name: value}}).
     workflow = job_input.get("workflow")
-    if workflow is None:
+    template_id = job_input.get("template")
+    batch = job_input.get("batch")
+    overrides = job_input.get("overrides")
+    if template_id is not None:
+        if workflow is not None or batch is not None:
+            return None, "Provide only one of 'workflow', 'template' or 'batch'"
+        workflow, error = WORKFLOW_TEMPLATES.get(str(template_id))
+        if error:
+            return None, error
+
+    if batch is not None:
+        if workflow is not None:
+            return None, "Provide either 'workflow' or 'batch', not both"
+        if overrides is not None:
+            return None, "'overrides' applies to 'workflow' or 'template', not to 'batch'"
+        if not isinstance(batch, list) or not batch:
+            return None, "'batch' must be a non-empty list of workflows"
+        if not all(isinstance(wf, dict) for wf in batch):
+            return None, "Every 'batch' item must be a workflow object"
+        workflows = batch
+    elif workflow is None:
         return None, "Missing 'workflow' parameter"
+    elif overrides is not None and not isinstance(workflow, dict):
+        return None, "'workflow' must be an object to apply 'overrides'"
+    elif isinstance(overrides, dict):
+        # A single override map patches the workflow/template for one prompt
+        patched, error = apply_overrides(workflow, overrides)
+        if error:
+            return None, f"Invalid 'overrides': {error}"
+        workflows = [patched]
+    elif overrides is not None:
+        if not isinstance(overrides, list) or not overrides:
+            return None, "'overrides' must be an object or a non-empty list of objects"
+        workflows = []
+        for i, item_overrides in enumerate(overrides):
+            patched, error = apply_overrides(workflow, item_overrides)
+            if error:
+                return None, f"Invalid 'overrides' item {i}: {error}"
+            workflows.append(patched)
+    else:
+        workflows = [workflow]
+
+    if len(workflows) > BATCH_MAX_ITEMS:
+        return None, f"Batch has {len(workflows)} items, the limit is {BATCH_MAX_ITEMS}"
 
     # Validate 'images' in input, if provided
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            isinstance(image, dict)
+            and "name" in image
+            and any(field in image for field in ("image", "url", "key"))
+            for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and one of 'image', 'url' or 'key'",
             )
+        for image in images:
+            name = str(image["name"])
+            if os.path.isabs(name) or ".." in name.replace("\\", "/").split("/"):
+                return None, f"Invalid image name '{name}'"
+
+    # Validate 'timeout_s' in input, if provided
+    timeout_s = job_input.get("timeout_s")
+    if timeout_s is not None:
+        if isinstance(timeout_s, bool):
+            return None, "'timeout_s' must be a number of seconds"
+        try:
+            timeout_s = float(timeout_s)
+        except (TypeError, ValueError):
+            return None, "'timeout_s' must be a number of seconds"
+        if not math.isfinite(timeout_s):
+            return None, "'timeout_s' must be a finite number of seconds"
+        if timeout_s < 0:
+            return None, "'timeout_s' must not be negative"
 
     # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
+    return {
+        "workflow": workflow,
+        "workflows": workflows,
+        "batch": batch is not None or isinstance(overrides, list),
+        "images": images,
+        "timeout_s": timeout_s,
+    }, None
 
 
 def check_server(url, retries=500, delay=50):
@@ -291,13 +1741,307 @@ def upload_images(images):
     }
 
 
+def _is_remote_image(image):
+    """True if an `images[]` entry points at a URL or bucket key instead of inline base64."""
+    if "url" in image or "key" in image:
+        return True
+    value = image.get("image")
+    return isinstance(value, str) and value.startswith(("http://", "https://"))
+
+
+class RemoteInputCache:
+    """
+    Fetches remote input images into ComfyUI's input directory.
+
+    Downloads go through one pooled ``requests.Session`` and land in a size-bounded
+    on-disk cache keyed by URL (or bucket/key). A cached file is revalidated with
+    ``If-None-Match`` / ``If-Modified-Since``, so a repeated input costs one 304.
+    Files are symlinked into the input directory (start.sh may link ``input`` onto the
+    network volume), so no bytes are copied per job. Existing files in the input
+    directory are never replaced, except stale links into this cache; placed links are
+    removed again by :meth:`release`, and cache entries in use by a job are never evicted.
+    """
+
+    # Names of the files this cache creates: sha256 of the key, plus download suffix
+    _FILE_RE = re.compile(r"^[0-9a-f]{64}(\.[0-9a-f]{32}\.partial)?$")
+
+    def __init__(
+        self,
+        cache_dir=INPUT_CACHE_DIR,
+        max_bytes=int(INPUT_CACHE_MAX_MB * 1024 * 1024),
+        max_file_bytes=int(INPUT_MAX_FILE_MB * 1024 * 1024),
+        concurrency=INPUT_FETCH_CONCURRENCY,
+        input_dir=COMFY_INPUT_DIR,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.concurrency = max(1, concurrency)
+        self.input_dir = input_dir
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.concurrency, pool_maxsize=self.concurrency
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # cache key -> {"path", "size", "etag", "last_modified"}, oldest first
+        self._entries = collections.OrderedDict()
+        self._pinned = collections.Counter()
+        self._lock = threading.Lock()
+        self._prepared = False
+        self.hits = 0
+        self.misses = 0
+
+    def _prepare(self):
+        if self._prepared:
+            return
+        # Entries are only tracked in memory; files left by a previous process are stale.
+        # Only files this cache names are removed, the directory is configurable.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for filename in os.listdir(self.cache_dir):
+            if self._FILE_RE.match(filename):
+                try:
+                    os.remove(os.path.join(self.cache_dir, filename))
+                except OSError:
+                    pass
+        self._prepared = True
+
+    def _source(self, image, bucket_creds, bucket_name):
+        """Return ``(cache_key, url)`` for an `images[]` entry."""
+        if "key" in image:
+            if not bucket_creds or not bucket_name:
+                raise ValueError("no bucket is configured for 'key' inputs")
+            key = str(image["key"]).lstrip("/")
+            url = _get_bucket_client(bucket_creds).generate_presigned_url(
+                "get_object", Params={"Bucket": bucket_name, "Key": key}, ExpiresIn=3600
+            )
+            return f"{bucket_name}/{key}", url
+        url = image.get("url") or image["image"]
+        return url, url
+
+    def _fetch(self, cache_key, url, deadline):
+        """Download ``url`` into the cache (or revalidate it) and return the cached path."""
+        with self._lock:
+            entry = self._entries.get(cache_key)
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError("input fetch budget exhausted")
+        with self.session.get(
+            url, headers=headers, stream=True, timeout=(min(10, remaining), remaining)
+        ) as response:
+            if response.status_code == 304 and entry:
+                with self._lock:
+                    self._entries.move_to_end(cache_key)
+                    self.hits += 1
+                return entry["path"]
+            response.raise_for_status()
+
+            declared = int(response.headers.get("Content-Length") or 0)
+            if declared > self.max_file_bytes:
+                raise ValueError(
+                    f"{declared} bytes exceeds the {self.max_file_bytes} byte input limit"
+                )
+
+            path = os.path.join(
+                self.cache_dir, hashlib.sha256(cache_key.encode("utf-8")).hexdigest()
+            )
+            partial = f"{path}.{uuid.uuid4().hex}.partial"
+            size = 0
+            try:
+                with open(partial, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            raise ValueError(
+                                f"exceeds the {self.max_file_bytes} byte input limit"
+                            )
+                        if time.time() > deadline:
+                            raise TimeoutError("input fetch budget exhausted")
+                        f.write(chunk)
+                os.replace(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+
+            with self._lock:
+                self._entries[cache_key] = {
+                    "path": path,
+                    "size": size,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+                self._entries.move_to_end(cache_key)
+                self.misses += 1
+                self._evict(keep=cache_key)
+            return path
+
+    def _evict(self, keep):
+        total = sum(e["size"] for e in self._entries.values())
+        for cache_key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if cache_key == keep or self._pinned[cache_key]:
+                continue
+            entry = self._entries.pop(cache_key)
+            total -= entry["size"]
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+
+    def _is_own_link(self, path):
+        """True if ``path`` is a symlink into this cache (possibly left by a crash)."""
+        if not os.path.islink(path):
+            return False
+        target = os.path.abspath(os.path.join(os.path.dirname(path), os.readlink(path)))
+        return target.startswith(os.path.abspath(self.cache_dir) + os.sep)
+
+    def _place(self, cached_path, name):
+        """
+        Expose a cached file to ComfyUI under ``name``. Returns ``(path, inode)`` of the
+        link, or None when the file went through ComfyUI's upload endpoint.
+        """
+        if os.path.isdir(self.input_dir):
+            dest = os.path.join(self.input_dir, name)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.lexists(dest):
+                if not self._is_own_link(dest):
+                    raise FileExistsError(
+                        f"'{name}' already exists in ComfyUI's input directory, use another name"
+                    )
+                os.remove(dest)
+            try:
+                os.symlink(os.path.abspath(cached_path), dest)
+                return dest, os.lstat(dest).st_ino
+            except OSError as e:
+                print(f"worker-comfyui - Cannot link {name} into {self.input_dir} ({e}), uploading it")
+        # ComfyUI runs elsewhere (or links are unsupported): stream the file through
+        # its upload endpoint
+        subfolder, filename = os.path.split(name)
+        with open(cached_path, "rb") as f:
+            response = self.session.post(
+                f"http://{COMFY_HOST}/upload/image",
+                files={
+                    "image": (filename, f, "application/octet-stream"),
+                    "subfolder": (None, subfolder),
+                    "overwrite": (None, "true"),
+                },
+                timeout=30,
+            )
+        response.raise_for_status()
+        return None
+
+    def release(self, placed):
+        """Remove the links placed for a finished job and unpin their cache entries."""
+        for cache_key, link in placed:
+            if link:
+                path, inode = link
+                try:
+                    # Only unlink what this job created, never a file that replaced it
+                    if os.lstat(path).st_ino == inode and self._is_own_link(path):
+                        os.remove(path)
+                except OSError:
+                    pass
+            with self._lock:
+                self._pinned[cache_key] -= 1
+                if self._pinned[cache_key] <= 0:
+                    del self._pinned[cache_key]
+
+    def fetch_all(self, images, bucket_creds=None, bucket_name=None, budget_s=INPUT_FETCH_BUDGET_S):
+        """
+        Fetch remote `images[]` entries concurrently within ``budget_s`` seconds.
+
+        Returns the same ``{"status", "message", "details"}`` shape as ``upload_images``
+        plus ``placed``, to be handed to :meth:`release` once the job is done.
+        """
+        self._prepare()
+        deadline = time.time() + budget_s
+        print(f"worker-comfyui - Fetching {len(images)} remote input(s)...")
+
+        placed = []
+
+        def fetch_one(image):
+            cache_key, url = self._source(image, bucket_creds, bucket_name)
+            with self._lock:
+                self._pinned[cache_key] += 1
+            link = None
+            try:
+                link = self._place(self._fetch(cache_key, url, deadline), str(image["name"]))
+                if time.time() > deadline:
+                    # fetch_all has already given up on this file
+                    raise TimeoutError("input fetch budget exhausted")
+            except Exception:
+                self.release([(cache_key, link)])
+                raise
+            with self._lock:
+                placed.append((cache_key, link))
+            return image["name"]
+
+        details = []
+        errors = []
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.concurrency, len(images)), thread_name_prefix="input-fetch"
+        )
+        futures = {executor.submit(fetch_one, image): image for image in images}
+        try:
+            for future in concurrent.futures.as_completed(
+                futures, timeout=max(0, deadline - time.time())
+            ):
+                name = futures[future].get("name", "unknown")
+                try:
+                    future.result()
+                    details.append(f"Successfully fetched {name}")
+                except Exception as e:
+                    errors.append(f"Error fetching {name}: {e}")
+        except concurrent.futures.TimeoutError:
+            for future, image in futures.items():
+                if not future.done():
+                    errors.append(
+                        f"Timeout fetching {image.get('name', 'unknown')} (budget {budget_s:.0f}s)"
+                    )
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        print(
+            f"worker-comfyui - Remote inputs: {len(details)} fetched, {len(errors)} failed "
+            f"(cache hits {self.hits}, misses {self.misses})"
+        )
+        if errors:
+            return {
+                "status": "error",
+                "message": "Some remote inputs failed to fetch",
+                "details": errors,
+                "placed": placed,
+            }
+        return {
+            "status": "success",
+            "message": "All remote inputs fetched successfully",
+            "details": details,
+            "placed": placed,
+        }
+
+
+REMOTE_INPUTS = RemoteInputCache()
+
+
 def get_available_models():
     """
-    Get list of available models from ComfyUI
+    Get list of available models, from the model index if it is running and from
+    ComfyUI's /object_info otherwise
 
     Returns:
         dict: Dictionary containing available models by type
     """
+    if MODEL_INVENTORY is not None and MODEL_INVENTORY.available:
+        return MODEL_INVENTORY.names_by_category()
+
     try:
         response = requests.get(f"http://{COMFY_HOST}/object_info", timeout=10)
         response.raise_for_status()
@@ -477,25 +2221,335 @@ def get_image_data(filename, subfolder, image_type):
         return None
 
 
-def _load_gcs_bucket_creds():
-    """Load GCS S3-compatible HMAC credentials.
-    
-    Tries the following files in order:
-    - /runpod-volume/keys/gc_hmac.json (in worker)
-    - /keys/gc_hmac.json (for local runs)
+class OutputJanitor:
+    """
+    Removes files the worker no longer needs without blocking the job path.
 
-    Expected JSON format:
-    {
-        "endpoint_url": "https://storage.googleapis.com",
-        "bucket": "hyper_tv",
-        "aws_access_key_id": "xxx",
-        "aws_secret_access_key": "xxx"
-    }
+    With OUTPUT_CLEANUP, a job's delivered outputs are handed over through
+    :meth:`discard` once the job collected them all and are deleted by the janitor thread. A periodic sweep removes orphaned staging files (left behind by
+    a crash mid-upload) and enforces the age and size quotas on ComfyUI's output and
+    temp directories, which may be symlinked onto the network volume by start.sh.
     """
-    primary_path = "/runpod-volume/keys/gc_hmac.json"
-    fallback_path = "/keys/gc_hmac.json"
-    try:
-        creds_path = primary_path if os.path.exists(primary_path) else (
+
+    def __init__(
+        self,
+        staging_dir=OUTPUT_STAGING_DIR,
+        quota_dirs=(COMFY_OUTPUT_DIR, COMFY_TEMP_DIR),
+        interval_s=JANITOR_INTERVAL_S,
+        staging_max_age_s=JANITOR_STAGING_MAX_AGE_S,
+        max_age_s=JANITOR_MAX_AGE_H * 3600,
+        max_bytes=int(JANITOR_MAX_GB * 1e9),
+        grace_s=JANITOR_GRACE_S,
+    ):
+        self.staging_dir = staging_dir
+        self.quota_dirs = quota_dirs
+        self.interval_s = interval_s
+        self.staging_max_age_s = staging_max_age_s
+        self.max_age_s = max_age_s
+        self.max_bytes = max_bytes
+        self.grace_s = grace_s
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self._discard_queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="output-janitor", daemon=True)
+        self._thread.start()
+
+    def discard(self, path):
+        """Schedule ``path`` for deletion; returns immediately."""
+        self._discard_queue.put(path)
+
+    def _run(self):
+        next_sweep = time.time()
+        while True:
+            try:
+                path = self._discard_queue.get(timeout=max(0, next_sweep - time.time()))
+                self._remove(path)
+                continue
+            except queue.Empty:
+                pass
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"worker-comfyui - Janitor sweep failed: {e}")
+            next_sweep = time.time() + self.interval_s
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.removed_files += 1
+        self.removed_bytes += size
+
+    @staticmethod
+    def _list_files(root):
+        """Return ``[(mtime, size, path)]`` for the regular files under ``root``."""
+        files = []
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def sweep(self):
+        """One cleanup pass over the staging and quota directories."""
+        now = time.time()
+        before = self.removed_files, self.removed_bytes
+
+        if os.path.isdir(self.staging_dir):
+            for mtime, _, path in self._list_files(self.staging_dir):
+                if now - mtime > max(self.staging_max_age_s, self.grace_s):
+                    self._remove(path)
+
+        for root in self.quota_dirs:
+            if not os.path.isdir(root):
+                continue
+            files = sorted(self._list_files(root))
+            total = sum(size for _, size, _ in files)
+            for mtime, size, path in files:
+                if now - mtime <= self.grace_s:
+                    break
+                expired = self.max_age_s > 0 and now - mtime > self.max_age_s
+                over_quota = self.max_bytes > 0 and total > self.max_bytes
+                if not (expired or over_quota):
+                    break
+                self._remove(path)
+                total -= size
+
+        removed = self.removed_files - before[0]
+        if removed:
+            print(
+                f"worker-comfyui - Janitor removed {removed} file(s), "
+                f"{(self.removed_bytes - before[1]) / 1e6:.1f} MB"
+            )
+
+
+# Created in __main__; None means outputs are left in place
+OUTPUT_JANITOR = None
+
+
+def _output_path(filename, subfolder, image_type):
+    """Local path of a ComfyUI output/temp file, or None if it is not ours to delete."""
+    root = {"output": COMFY_OUTPUT_DIR, "temp": COMFY_TEMP_DIR}.get(image_type)
+    if not root or not filename:
+        return None
+    path = os.path.normpath(os.path.join(root, subfolder or "", filename))
+    if not path.startswith(os.path.normpath(root) + os.sep):
+        return None
+    return path
+
+
+def _download_output_to_file(filename, subfolder, image_type, suffix):
+    """
+    Stream an output file from the ComfyUI /view endpoint into a staging file,
+    hashing the bytes on the way so large outputs are never held in memory.
+
+    Returns:
+        tuple: ``(temp_file_path, sha256_hex, size)``, or None if the download failed.
+    """
+    print(
+        f"worker-comfyui - Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}"
+    )
+    data = {"filename": filename, "subfolder": subfolder, "type": image_type}
+    url_values = urllib.parse.urlencode(data)
+    temp_file = None
+    try:
+        with requests.get(
+            f"http://{COMFY_HOST}/view?{url_values}", timeout=60, stream=True
+        ) as response:
+            response.raise_for_status()
+            os.makedirs(OUTPUT_STAGING_DIR, exist_ok=True)
+            digest = hashlib.sha256()
+            size = 0
+            with tempfile.NamedTemporaryFile(
+                dir=OUTPUT_STAGING_DIR, suffix=suffix, delete=False
+            ) as temp_file:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    temp_file.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+        print(
+            f"worker-comfyui - Wrote {size} bytes of {filename} to temporary file: {temp_file.name}"
+        )
+        return temp_file.name, digest.hexdigest(), size
+    except (requests.RequestException, OSError) as e:
+        print(f"worker-comfyui - Error fetching image data for {filename}: {e}")
+        if temp_file is not None and os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+        return None
+
+
+# boto3 clients for the dedup HEAD/presign calls, keyed by endpoint and access id
+_BUCKET_CLIENTS = {}
+
+
+def _get_bucket_client(bucket_creds):
+    cache_key = (bucket_creds.get("endpointUrl"), bucket_creds.get("accessId"))
+    client = _BUCKET_CLIENTS.get(cache_key)
+    if client is None:
+        client, _ = get_boto_client(bucket_creds)
+        _BUCKET_CLIENTS[cache_key] = client
+    return client
+
+
+def _upload_part(client, bucket_name, key, upload_id, file_path, part_number, offset, length):
+    """Upload one part, reading only its byte range from disk; retried on its own."""
+    for attempt in range(MULTIPART_PART_RETRIES + 1):
+        try:
+            with open(file_path, "rb") as f:
+                f.seek(offset)
+                body = f.read(length)
+            response = client.upload_part(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        except Exception as e:
+            if attempt >= MULTIPART_PART_RETRIES:
+                raise
+            delay = 2 ** attempt
+            print(
+                f"worker-comfyui - Part {part_number} of {key} failed ({e}), retrying in {delay}s..."
+            )
+            time.sleep(delay)
+
+
+def upload_multipart(file_name, file_path, bucket_creds, bucket_name, prefix):
+    """
+    Upload a large file as parallel multipart upload and return a presigned URL.
+
+    Parts of MULTIPART_PART_SIZE_MB are read straight from disk by
+    MULTIPART_CONCURRENCY workers, so at most that many parts are in memory at once.
+    A failing part is retried individually; if it still fails the upload is aborted.
+    """
+    key = f"{prefix}/{file_name}" if prefix else file_name
+    client = _get_bucket_client(bucket_creds)
+    if client is None:
+        raise ValueError("Could not create a bucket client for multipart upload")
+
+    size = os.path.getsize(file_path)
+    part_size = max(int(MULTIPART_PART_SIZE_MB * 1024 * 1024), 5 * 1024 * 1024)
+    ranges = [
+        (number, offset, min(part_size, size - offset))
+        for number, offset in enumerate(range(0, size, part_size), start=1)
+    ]
+    started = time.time()
+    upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key)["UploadId"]
+    print(
+        f"worker-comfyui - Multipart upload of {file_name} ({size} bytes, {len(ranges)} parts) to {bucket_name}/{key}..."
+    )
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, MULTIPART_CONCURRENCY)
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _upload_part, client, bucket_name, key, upload_id, file_path, number, offset, length
+                )
+                for number, offset, length in ranges
+            ]
+            parts = [future.result() for future in futures]
+        client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": sorted(parts, key=lambda p: p["PartNumber"])},
+        )
+    except Exception:
+        try:
+            client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+        except Exception as abort_err:
+            print(f"worker-comfyui - Failed to abort multipart upload {upload_id}: {abort_err}")
+        raise
+
+    elapsed = time.time() - started
+    print(
+        f"worker-comfyui - Multipart upload of {file_name} done in {elapsed:.1f}s ({size / max(elapsed, 1e-6) / 1e6:.1f} MB/s)"
+    )
+    return client.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket_name, "Key": key}, ExpiresIn=604800
+    )
+
+
+def _upload_to_bucket(file_name, file_path, size, bucket_creds, bucket_name, prefix):
+    """Upload with a single PUT, or as parallel multipart upload above the size threshold."""
+    if size >= MULTIPART_THRESHOLD_MB * 1024 * 1024:
+        return upload_multipart(file_name, file_path, bucket_creds, bucket_name, prefix)
+    return upload_file_to_bucket(file_name, file_path, bucket_creds, bucket_name, prefix)
+
+
+def upload_deduplicated(
+    file_path, digest, size, file_extension, bucket_creds, bucket_name
+):
+    """
+    Upload a file under a content-addressed key, skipping the PUT if it already exists.
+
+    The key is ``<OUTPUT_DEDUP_PREFIX>/<sha256[:2]>/<sha256><ext>``, so identical bytes
+    (retries, cached executions, static masks) map to a single object.
+
+    Returns:
+        tuple: ``(presigned_url, hit)`` where ``hit`` is True if the upload was skipped.
+    """
+    key_dir = f"{OUTPUT_DEDUP_PREFIX}/{digest[:2]}"
+    object_name = f"{digest}{file_extension}"
+    key = f"{key_dir}/{object_name}"
+
+    client = _get_bucket_client(bucket_creds)
+    if client is not None:
+        try:
+            head = client.head_object(Bucket=bucket_name, Key=key)
+            if head.get("ContentLength") == size:
+                print(f"worker-comfyui - Dedup hit for {key}, skipping upload of {size} bytes")
+                presigned_url = client.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": bucket_name, "Key": key},
+                    ExpiresIn=604800,
+                )
+                return presigned_url, True
+        except Exception as e:
+            error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if error_code not in ("404", "NoSuchKey", "NotFound"):
+                print(f"worker-comfyui - Dedup lookup of {key} failed, uploading anyway: {e}")
+
+    print(f"worker-comfyui - Uploading {object_name} to bucket {bucket_name} with prefix '{key_dir}'...")
+    presigned_url = _upload_to_bucket(
+        object_name, file_path, size, bucket_creds, bucket_name, key_dir
+    )
+    return presigned_url, False
+
+
+def _load_gcs_bucket_creds():
+    """Load GCS S3-compatible HMAC credentials.
+    
+    Tries the following files in order:
+    - /runpod-volume/keys/gc_hmac.json (in worker)
+    - /keys/gc_hmac.json (for local runs)
+
+    Expected JSON format:
+    {
+        "endpoint_url": "https://storage.googleapis.com",
+        "bucket": "hyper_tv",
+        "aws_access_key_id": "xxx",
+        "aws_secret_access_key": "xxx"
+    }
+    """
+    primary_path = "/runpod-volume/keys/gc_hmac.json"
+    fallback_path = "/keys/gc_hmac.json"
+    try:
+        creds_path = primary_path if os.path.exists(primary_path) else (
             fallback_path if os.path.exists(fallback_path) else None
         )
         if not creds_path:
@@ -613,65 +2667,275 @@ def _handle_local_mode(job_input, upload_prefix, gcs_bucket_creds, gcs_bucket_na
         return {"error": f"Local mode error: {e}"}
 
 
-def handler(job):
+class JobCancelledError(Exception):
+    """Raised inside the job thread once the job was cancelled or ran past its deadline."""
+
+    def __init__(self, reason, prompt_ids=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.prompt_ids = prompt_ids or []
+
+
+def cancel_prompt(prompt_id):
     """
-    Handles a job using ComfyUI via websockets for status and image retrieval.
+    Stop a single prompt in ComfyUI without touching anybody else's work.
+
+    A pending prompt is removed from the queue; a running one is interrupted. The
+    prompt_id is passed to /interrupt as well, which recent ComfyUI versions use to
+    ignore the request if a different prompt is executing by then.
 
     Args:
-        job (dict): A dictionary containing job details and input parameters.
+        prompt_id (str): The prompt to stop.
 
     Returns:
-        dict: A dictionary containing either an error message or a success status with generated images.
+        str: One of 'dequeued', 'interrupted', 'not_found' or 'error'.
     """
-    job_input = job["input"]
-    job_id = job["id"]
+    try:
+        response = requests.get(f"http://{COMFY_HOST}/queue", timeout=5)
+        response.raise_for_status()
+        queue_state = response.json()
+        pending = {item[1] for item in queue_state.get("queue_pending", [])}
+        result = "not_found"
+
+        if prompt_id in pending:
+            requests.post(
+                f"http://{COMFY_HOST}/queue", json={"delete": [prompt_id]}, timeout=5
+            ).raise_for_status()
+            result = "dequeued"
+            # The prompt may have started between the two calls – re-read the queue
+            response = requests.get(f"http://{COMFY_HOST}/queue", timeout=5)
+            response.raise_for_status()
+            queue_state = response.json()
 
-    # Optional output controls and upload prefix for both remote and local flows
-    return_base64 = bool(job_input.get("return_base64", False))
-    path_from_request = job_input.get("path") or ""
-    path_from_request = str(path_from_request).strip().strip("/")
-    upload_prefix = "rp" if not path_from_request else f"rp/{path_from_request}"
-    gcs_bucket_creds, gcs_bucket_name = _load_gcs_bucket_creds()
+        running = {item[1] for item in queue_state.get("queue_running", [])}
+        if prompt_id in running:
+            requests.post(
+                f"http://{COMFY_HOST}/interrupt",
+                json={"prompt_id": prompt_id},
+                timeout=5,
+            ).raise_for_status()
+            result = "interrupted"
 
-    # Local test mode: bypass ComfyUI network calls
-    if job_input.get("local", False) or os.environ.get("LOCAL_MODE", "false").lower() == "true":
-        return _handle_local_mode(job_input, upload_prefix, gcs_bucket_creds, gcs_bucket_name)
+        print(f"worker-comfyui - Cancel prompt {prompt_id}: {result}")
+        return result
+    except (requests.RequestException, ValueError, IndexError, TypeError) as e:
+        print(f"worker-comfyui - Failed to cancel prompt {prompt_id}: {e}")
+        return "error"
 
-    # Validate input for remote (ComfyUI) flow
-    validated_data, error_message = validate_input(job_input)
-    if error_message:
-        return {"error": error_message}
 
-    workflow = validated_data["workflow"]
-    input_images = validated_data.get("images")
+class JobControl:
+    """
+    Cancellation and deadline state of one job.
 
-    # Make sure that the ComfyUI HTTP API is available before proceeding
-    if not check_server(
-        f"http://{COMFY_HOST}/",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    ):
-        return {
-            "error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."
-        }
+    Shared between the thread running :func:`handler` and the asyncio task RunPod
+    cancels when a job is cancelled or times out. Every prompt the job queues is
+    registered here so a cancel can stop exactly those prompts in ComfyUI.
+    """
 
-    # Upload input images if they exist
-    if input_images:
-        upload_result = upload_images(input_images)
-        if upload_result["status"] == "error":
-            # Return upload errors
-            return {
-                "error": "Failed to upload one or more input images",
-                "details": upload_result["details"],
-            }
+    def __init__(self, job_id, timeout_s=None):
+        self.job_id = job_id
+        self.deadline = None
+        self.reason = None
+        self.prompt_ids = []
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self.set_timeout(timeout_s)
+
+    def set_timeout(self, timeout_s):
+        self.timeout_s = timeout_s
+        self.deadline = time.time() + timeout_s if timeout_s else None
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def remaining(self):
+        """Seconds left until the deadline, or None if the job has no deadline."""
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def add_prompt(self, prompt_id):
+        """Register a queued prompt; stops it right away if the job is already cancelled."""
+        with self._lock:
+            self.prompt_ids.append(prompt_id)
+            cancelled = self._cancelled.is_set()
+        if cancelled:
+            cancel_prompt(prompt_id)
+
+    def cancel(self, reason):
+        """Mark the job as cancelled and stop all of its prompts in ComfyUI."""
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self.reason = reason
+            self._cancelled.set()
+            prompt_ids = list(self.prompt_ids)
+        print(f"worker-comfyui - Job {self.job_id} {reason}")
+        for prompt_id in prompt_ids:
+            cancel_prompt(prompt_id)
+
+    def check(self):
+        """Raise JobCancelledError if the job was cancelled or its deadline passed."""
+        if (
+            not self._cancelled.is_set()
+            and self.deadline is not None
+            and time.time() >= self.deadline
+        ):
+            self.cancel(f"exceeded its deadline of {self.timeout_s:g}s")
+        if self._cancelled.is_set():
+            raise JobCancelledError(self.reason, list(self.prompt_ids))
+
+
+# Compact record for the websocket messages the handler acts upon. `kind` is one of
+# 'status', 'done', 'error' or 'interrupted'; `data` holds the message payload.
+WsEvent = collections.namedtuple("WsEvent", ["kind", "prompt_id", "data"])
+
+# ComfyUI serialises messages as {"type": ..., "data": {...}}, so the type is found
+# within the first few bytes and frames can be classified without a full JSON parse.
+_WS_TYPE_RE = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"]+)"')
+_WS_PROMPT_ID_RE = re.compile(r'"prompt_id"\s*:\s*"([^"]+)"')
+# Message types that are scoped to a prompt and mapped to a WsEvent kind
+_WS_PROMPT_EVENTS = {
+    "executing": "done",
+    "execution_success": "done",
+    "execution_error": "error",
+    "execution_interrupted": "interrupted",
+}
+
+
+class ComfyEventDecoder:
+    """
+    Turns raw websocket frames into :data:`WsEvent` records.
+
+    Most traffic on a busy worker is irrelevant to the job (progress, previews,
+    executing-node updates, crystools monitor messages, other clients' prompts), so
+    frames are pre-filtered with a regex on the message type, a lookup of the
+    ``prompt_id`` in ``prompt_ids`` and a check for ``null`` (node=None marks the
+    end of a prompt) before anything is parsed. Counters record how much work that
+    saved so the per-message overhead shows up in the job logs.
+    """
+
+    def __init__(self, prompt_ids):
+        # Any container supporting `in` – the live dict of pending prompts works too
+        self.prompt_ids = prompt_ids
+        self.frames = 0
+        self.skipped = 0
+        self.parsed = 0
+        self.decode_s = 0.0
+
+    def decode(self, frame):
+        """Return a WsEvent for relevant text frames, otherwise None."""
+        started = time.perf_counter()
+        self.frames += 1
+        try:
+            return self._decode(frame)
+        finally:
+            self.decode_s += time.perf_counter() - started
+
+    def _decode(self, frame):
+        if not isinstance(frame, str):
+            # Binary frames carry preview images
+            self.skipped += 1
+            return None
+
+        match = _WS_TYPE_RE.match(frame)
+        msg_type = match.group(1) if match else None
+        if msg_type is not None and msg_type != "status":
+            kind = _WS_PROMPT_EVENTS.get(msg_type)
+            prompt_match = _WS_PROMPT_ID_RE.search(frame) if kind else None
+            if (
+                prompt_match is None
+                or prompt_match.group(1) not in self.prompt_ids
+                or (msg_type == "executing" and "null" not in frame)
+            ):
+                self.skipped += 1
+                return None
+
+        self.parsed += 1
+        try:
+            message = _json_loads(frame)
+        except ValueError:
+            print(f"worker-comfyui - Received invalid JSON message via websocket.")
+            return None
+        if not isinstance(message, dict):
+            return None
+
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if msg_type == "status":
+            return WsEvent("status", None, data)
+        kind = _WS_PROMPT_EVENTS.get(msg_type)
+        prompt_id = data.get("prompt_id")
+        if kind is None or prompt_id not in self.prompt_ids:
+            return None
+        if msg_type == "executing" and data.get("node") is not None:
+            return None
+        return WsEvent(kind, prompt_id, data)
+
+    def summary(self):
+        return (
+            f"{self.frames} websocket frame(s), {self.skipped} skipped before parsing, "
+            f"{self.parsed} parsed, {self.decode_s * 1000:.2f} ms decoding"
+        )
+
+
+def _queue_prompt(workflow, client_id, control):
+    """
+    Queue one workflow on ComfyUI and register its prompt_id with the job.
+
+    Returns:
+        str: The prompt_id assigned by ComfyUI.
 
+    Raises:
+        ValueError: If the workflow could not be queued.
+    """
+    try:
+        queued_workflow = queue_workflow(workflow, client_id)
+        prompt_id = queued_workflow.get("prompt_id")
+        if not prompt_id:
+            raise ValueError(
+                f"Missing 'prompt_id' in queue response: {queued_workflow}"
+            )
+        print(f"worker-comfyui - Queued workflow with ID: {prompt_id}")
+        control.add_prompt(prompt_id)
+        return prompt_id
+    except requests.RequestException as e:
+        print(f"worker-comfyui - Error queuing workflow: {e}")
+        raise ValueError(f"Error queuing workflow: {e}")
+    except Exception as e:
+        print(f"worker-comfyui - Unexpected error queuing workflow: {e}")
+        # For ValueError exceptions from queue_workflow, pass through the original message
+        if isinstance(e, ValueError):
+            raise e
+        else:
+            raise ValueError(f"Unexpected error queuing workflow: {e}")
+
+
+def _execute_workflows(items, control, raise_queue_errors=True):
+    """
+    Queue workflows on ComfyUI and block until the websocket reports all of them done.
+
+    All workflows are enqueued up front over a single websocket connection so the GPU
+    goes straight from one prompt to the next. Each item is updated in place with its
+    ``prompt_id``, a ``done`` flag and the ``errors`` ComfyUI reported for it.
+
+    Args:
+        items (list): Dicts with a 'workflow' key, one per prompt to execute.
+        control (JobControl): Deadline and cancellation state of the job.
+        raise_queue_errors (bool): Re-raise a queueing failure instead of recording it
+            on the item (used for single-workflow jobs).
+
+    Raises:
+        ComfyUICrashedError: If the supervised ComfyUI process died while we waited.
+        JobCancelledError: If the job was cancelled or ran past its deadline.
+        ValueError: If a workflow could not be queued and raise_queue_errors is set.
+    """
     ws = None
+    decoder = None
     client_id = str(uuid.uuid4())
-    prompt_id = None
-    output_data = []
-    errors = []
 
     try:
+        control.check()
+
         # Establish WebSocket connection
         ws_url = f"ws://{COMFY_HOST}/ws?clientId={client_id}"
         print(f"worker-comfyui - Connecting to websocket: {ws_url}")
@@ -679,63 +2943,82 @@ def handler(job):
         ws.connect(ws_url, timeout=10)
         print(f"worker-comfyui - Websocket connected")
 
-        # Queue the workflow
-        try:
-            queued_workflow = queue_workflow(workflow, client_id)
-            prompt_id = queued_workflow.get("prompt_id")
-            if not prompt_id:
-                raise ValueError(
-                    f"Missing 'prompt_id' in queue response: {queued_workflow}"
-                )
-            print(f"worker-comfyui - Queued workflow with ID: {prompt_id}")
-        except requests.RequestException as e:
-            print(f"worker-comfyui - Error queuing workflow: {e}")
-            raise ValueError(f"Error queuing workflow: {e}")
-        except Exception as e:
-            print(f"worker-comfyui - Unexpected error queuing workflow: {e}")
-            # For ValueError exceptions from queue_workflow, pass through the original message
-            if isinstance(e, ValueError):
-                raise e
-            else:
-                raise ValueError(f"Unexpected error queuing workflow: {e}")
+        # Queue the workflows
+        pending = {}
+        for item in items:
+            item["prompt_id"] = None
+            item["done"] = False
+            item["errors"] = []
+            try:
+                prompt_id = _queue_prompt(item["workflow"], client_id, control)
+            except ValueError as e:
+                if raise_queue_errors:
+                    raise
+                item["errors"].append(str(e))
+                item["done"] = True
+                continue
+            item["prompt_id"] = prompt_id
+            pending[prompt_id] = item
 
         # Wait for execution completion via WebSocket
-        print(f"worker-comfyui - Waiting for workflow execution ({prompt_id})...")
-        execution_done = False
-        while True:
+        print(
+            f"worker-comfyui - Waiting for workflow execution ({', '.join(pending)})..."
+        )
+        decoder = ComfyEventDecoder(pending)
+        while pending:
+            control.check()
+            remaining = control.remaining()
+            if remaining is not None:
+                # Never block on the socket past the job's deadline
+                ws.settimeout(max(0.5, min(10, remaining)))
             try:
                 out = ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message.get("type") == "status":
-                        status_data = message.get("data", {}).get("status", {})
-                        print(
-                            f"worker-comfyui - Status update: {status_data.get('exec_info', {}).get('queue_remaining', 'N/A')} items remaining in queue"
-                        )
-                    elif message.get("type") == "executing":
-                        data = message.get("data", {})
-                        if (
-                            data.get("node") is None
-                            and data.get("prompt_id") == prompt_id
-                        ):
-                            print(
-                                f"worker-comfyui - Execution finished for prompt {prompt_id}"
-                            )
-                            execution_done = True
-                            break
-                    elif message.get("type") == "execution_error":
-                        data = message.get("data", {})
-                        if data.get("prompt_id") == prompt_id:
-                            error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
-                            print(
-                                f"worker-comfyui - Execution error received: {error_details}"
-                            )
-                            errors.append(f"Workflow execution error: {error_details}")
-                            break
-                else:
+                if COMFY_HEALTH is not None:
+                    COMFY_HEALTH.note_heartbeat()
+                event = decoder.decode(out)
+                if event is None:
+                    continue
+                if event.kind == "status":
+                    status_data = event.data.get("status", {})
+                    print(
+                        f"worker-comfyui - Status update: {status_data.get('exec_info', {}).get('queue_remaining', 'N/A')} items remaining in queue"
+                    )
+                elif event.prompt_id not in pending:
+                    # Already finished (e.g. execution_success after executing=None)
                     continue
+                elif event.kind == "done":
+                    print(
+                        f"worker-comfyui - Execution finished for prompt {event.prompt_id}"
+                    )
+                    pending.pop(event.prompt_id)["done"] = True
+                elif event.kind == "error":
+                    data = event.data
+                    error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
+                    print(
+                        f"worker-comfyui - Execution error received: {error_details}"
+                    )
+                    item = pending.pop(event.prompt_id)
+                    item["errors"].append(f"Workflow execution error: {error_details}")
+                    item["done"] = True
+                elif event.kind == "interrupted":
+                    control.check()
+                    print(
+                        f"worker-comfyui - Execution of prompt {event.prompt_id} was interrupted"
+                    )
+                    item = pending.pop(event.prompt_id)
+                    item["errors"].append(
+                        f"Workflow execution was interrupted at node {event.data.get('node_id')}"
+                    )
+                    item["done"] = True
             except websocket.WebSocketTimeoutException:
-                print(f"worker-comfyui - Websocket receive timed out. Still waiting...")
+                # A hung socket is not always closed when ComfyUI dies, so double-check
+                # with the supervisor instead of waiting forever.
+                if _comfy_crashed():
+                    _raise_comfy_crashed(
+                        f"while executing prompt(s) {', '.join(pending)}"
+                    )
+                if control.remaining() is None or control.remaining() > 0:
+                    print(f"worker-comfyui - Websocket receive timed out. Still waiting...")
                 continue
             except websocket.WebSocketConnectionClosedException as closed_err:
                 try:
@@ -757,137 +3040,464 @@ def handler(job):
                     # If _attempt_websocket_reconnect fails, it raises this exception
                     # Let this exception propagate to the outer handler's except block
                     raise reconn_failed_err
+    finally:
+        if decoder is not None:
+            print(f"worker-comfyui - Websocket decoding: {decoder.summary()}")
+        if ws and ws.connected:
+            print(f"worker-comfyui - Closing websocket connection.")
+            ws.close()
 
-            except json.JSONDecodeError:
-                print(f"worker-comfyui - Received invalid JSON message via websocket.")
-
-        if not execution_done and not errors:
-            raise ValueError(
-                "Workflow monitoring loop exited without confirmation of completion or error."
-            )
 
-        # Fetch history even if there were execution errors, some outputs might exist
-        print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
-        history = get_history(prompt_id)
+def _note_delivered(delivered, filename, subfolder, image_type):
+    """Remember a delivered ComfyUI output so it can be discarded after the job."""
+    if delivered is None:
+        return
+    path = _output_path(filename, subfolder, image_type)
+    if path:
+        delivered.add(path)
+
+
+def _collect_outputs(
+    prompt_id,
+    errors,
+    return_base64,
+    gcs_bucket_creds,
+    gcs_bucket_name,
+    upload_prefix,
+    dedup=False,
+    upload_stats=None,
+    delivered=None,
+    control=None,
+):
+    """
+    Fetch the outputs of an executed prompt and deliver them as URLs or base64.
 
-        if prompt_id not in history:
-            error_msg = f"Prompt ID {prompt_id} not found in history after execution."
-            print(f"worker-comfyui - {error_msg}")
-            if not errors:
-                return {"error": error_msg}
-            else:
-                errors.append(error_msg)
-                return {
-                    "error": "Job processing failed, prompt ID not found in history.",
-                    "details": errors,
-                }
+    Args:
+        prompt_id (str): The executed prompt.
+        errors (list): Problems with individual outputs are appended here.
+        return_base64 (bool): Return base64 even if bucket credentials are available.
+        gcs_bucket_creds (dict): Bucket credentials, or None.
+        gcs_bucket_name (str): Bucket name, or None.
+        upload_prefix (str): Key prefix for uploads.
+        dedup (bool): Store uploads under content-addressed keys and skip existing ones.
+        upload_stats (dict): Dedup counters ('hits', 'uploads', 'bytes_saved') to update.
+        delivered (set): Local paths of delivered (and skipped temp) outputs are added here.
+        control (JobControl): Checked before every output; a cancelled job stops
+            downloading and uploading.
 
-        prompt_history = history.get(prompt_id, {})
-        outputs = prompt_history.get("outputs", {})
+    Returns:
+        list: Output entries with 'filename', 'type' and 'data' keys.
+    """
+    output_data = []
+    if upload_stats is None:
+        upload_stats = {"hits": 0, "uploads": 0, "bytes_saved": 0}
+
+    # Fetch history even if there were execution errors, some outputs might exist
+    print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
+    history = get_history(prompt_id)
+
+    if prompt_id not in history:
+        error_msg = f"Prompt ID {prompt_id} not found in history after execution."
+        print(f"worker-comfyui - {error_msg}")
+        errors.append(error_msg)
+        return output_data
+
+    prompt_history = history.get(prompt_id, {})
+    outputs = prompt_history.get("outputs", {})
+
+    if not outputs:
+        warning_msg = f"No outputs found in history for prompt {prompt_id}."
+        print(f"worker-comfyui - {warning_msg}")
+        if not errors:
+            errors.append(warning_msg)
+
+    print(f"worker-comfyui - Processing {len(outputs)} output nodes...")
+    for node_id, node_output in outputs.items():
+        if "images" in node_output:
+            print(
+                f"worker-comfyui - Node {node_id} contains {len(node_output['images'])} image(s)"
+            )
+            for image_info in node_output["images"]:
+                if control is not None:
+                    # RunPod may have cancelled the job and moved on to the next one
+                    control.check()
+                filename = image_info.get("filename")
+                subfolder = image_info.get("subfolder", "")
+                img_type = image_info.get("type")
+
+                # skip temp images
+                if img_type == "temp":
+                    print(
+                        f"worker-comfyui - Skipping image {filename} because type is 'temp'"
+                    )
+                    _note_delivered(delivered, filename, subfolder, img_type)
+                    continue
 
-        if not outputs:
-            warning_msg = f"No outputs found in history for prompt {prompt_id}."
-            print(f"worker-comfyui - {warning_msg}")
-            if not errors:
-                errors.append(warning_msg)
+                if not filename:
+                    warn_msg = f"Skipping image in node {node_id} due to missing filename: {image_info}"
+                    print(f"worker-comfyui - {warn_msg}")
+                    errors.append(warn_msg)
+                    continue
 
-        print(f"worker-comfyui - Processing {len(outputs)} output nodes...")
-        for node_id, node_output in outputs.items():
-            if "images" in node_output:
-                print(
-                    f"worker-comfyui - Node {node_id} contains {len(node_output['images'])} image(s)"
-                )
-                for image_info in node_output["images"]:
-                    filename = image_info.get("filename")
-                    subfolder = image_info.get("subfolder", "")
-                    img_type = image_info.get("type")
+                file_extension = os.path.splitext(filename)[1] or ".png"
 
-                    # skip temp images
-                    if img_type == "temp":
+                # Prefer GCS upload by default; base64 only if requested or no creds
+                if not return_base64 and gcs_bucket_creds and gcs_bucket_name:
+                    staged = _download_output_to_file(
+                        filename, subfolder, img_type, file_extension
+                    )
+                    if staged is None:
+                        error_msg = f"Failed to fetch image data for {filename} from /view endpoint."
+                        errors.append(error_msg)
+                        continue
+                    temp_file_path, digest, size = staged
+                    try:
+                        if dedup:
+                            presigned_url, hit = upload_deduplicated(
+                                temp_file_path,
+                                digest,
+                                size,
+                                file_extension,
+                                gcs_bucket_creds,
+                                gcs_bucket_name,
+                            )
+                            upload_stats["hits" if hit else "uploads"] += 1
+                            if hit:
+                                upload_stats["bytes_saved"] += size
+                        else:
+                            print(
+                                f"worker-comfyui - Uploading {filename} to bucket {gcs_bucket_name} with prefix '{upload_prefix}'..."
+                            )
+                            presigned_url = _upload_to_bucket(
+                                filename,
+                                temp_file_path,
+                                size,
+                                gcs_bucket_creds,
+                                gcs_bucket_name,
+                                upload_prefix,
+                            )
                         print(
-                            f"worker-comfyui - Skipping image {filename} because type is 'temp'"
+                            f"worker-comfyui - Uploaded {filename} to bucket: {presigned_url}"
                         )
+                        output_data.append(
+                            {
+                                "filename": filename,
+                                "type": "url",
+                                "data": presigned_url,
+                            }
+                        )
+                        _note_delivered(delivered, filename, subfolder, img_type)
+                    except Exception as e:
+                        error_msg = (
+                            f"Error uploading {filename} to bucket {gcs_bucket_name} "
+                            f"(endpoint={gcs_bucket_creds.get('endpointUrl')}, prefix={upload_prefix}): {e}"
+                        )
+                        print(f"worker-comfyui - {error_msg}")
+                        errors.append(error_msg)
+                    finally:
+                        try:
+                            os.remove(temp_file_path)
+                        except OSError:
+                            pass
+                else:
+                    image_bytes = get_image_data(filename, subfolder, img_type)
+                    if not image_bytes:
+                        error_msg = f"Failed to fetch image data for {filename} from /view endpoint."
+                        errors.append(error_msg)
                         continue
+                    try:
+                        base64_image = base64.b64encode(image_bytes).decode(
+                            "utf-8"
+                        )
+                        output_data.append(
+                            {
+                                "filename": filename,
+                                "type": "base64",
+                                "data": base64_image,
+                            }
+                        )
+                        print(f"worker-comfyui - Encoded {filename} as base64")
+                        _note_delivered(delivered, filename, subfolder, img_type)
+                    except Exception as e:
+                        error_msg = f"Error encoding {filename} to base64: {e}"
+                        print(f"worker-comfyui - {error_msg}")
+                        errors.append(error_msg)
 
-                    if not filename:
-                        warn_msg = f"Skipping image in node {node_id} due to missing filename: {image_info}"
-                        print(f"worker-comfyui - {warn_msg}")
-                        errors.append(warn_msg)
-                        continue
+        # Check for other output types
+        other_keys = [k for k in node_output.keys() if k != "images"]
+        if other_keys:
+            warn_msg = (
+                f"Node {node_id} produced unhandled output keys: {other_keys}."
+            )
+            print(f"worker-comfyui - WARNING: {warn_msg}")
+            print(
+                f"worker-comfyui - --> If this output is useful, please consider opening an issue on GitHub to discuss adding support."
+            )
 
-                    image_bytes = get_image_data(filename, subfolder, img_type)
+    return output_data
 
-                    if image_bytes:
-                        file_extension = os.path.splitext(filename)[1] or ".png"
-
-                        # Prefer GCS upload by default; base64 only if requested or no creds
-                        if not return_base64 and gcs_bucket_creds and gcs_bucket_name:
-                            try:
-                                os.makedirs("/runpod-volume/tmp", exist_ok=True)
-                                with tempfile.NamedTemporaryFile(dir="/runpod-volume/tmp", suffix=file_extension, delete=False) as temp_file:
-                                    temp_file.write(image_bytes)
-                                    temp_file_path = temp_file.name
-                                print(f"worker-comfyui - Wrote image bytes to temporary file: {temp_file_path}")
-                                print(
-                                    f"worker-comfyui - Uploading {filename} to bucket {gcs_bucket_name} with prefix '{upload_prefix}'..."
-                                )
-                                presigned_url = upload_file_to_bucket(
-                                    filename,
-                                    temp_file_path,
-                                    gcs_bucket_creds,
-                                    gcs_bucket_name,
-                                    upload_prefix,
-                                )
-                                os.remove(temp_file_path)
-                                print(
-                                    f"worker-comfyui - Uploaded {filename} to bucket: {presigned_url}"
-                                )
-                                output_data.append(
-                                    {
-                                        "filename": filename,
-                                        "type": "url",
-                                        "data": presigned_url,
-                                    }
-                                )
-                            except Exception as e:
-                                error_msg = (
-                                    f"Error uploading {filename} to bucket {gcs_bucket_name} "
-                                    f"(endpoint={gcs_bucket_creds.get('endpointUrl')}, prefix={upload_prefix}): {e}"
-                                )
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                        else:
-                            try:
-                                base64_image = base64.b64encode(image_bytes).decode(
-                                    "utf-8"
-                                )
-                                output_data.append(
-                                    {
-                                        "filename": filename,
-                                        "type": "base64",
-                                        "data": base64_image,
-                                    }
-                                )
-                                print(f"worker-comfyui - Encoded {filename} as base64")
-                            except Exception as e:
-                                error_msg = f"Error encoding {filename} to base64: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                    else:
-                        error_msg = f"Failed to fetch image data for {filename} from /view endpoint."
-                        errors.append(error_msg)
 
-            # Check for other output types
-            other_keys = [k for k in node_output.keys() if k != "images"]
-            if other_keys:
-                warn_msg = (
-                    f"Node {node_id} produced unhandled output keys: {other_keys}."
-                )
-                print(f"worker-comfyui - WARNING: {warn_msg}")
+def _batch_result(items):
+    """
+    Build the response of a batch job: one entry per item, partial success allowed.
+
+    An item with outputs and errors is reported as 'partial'. The job only reports a
+    top-level error when every item failed.
+    """
+    results = []
+    for item in items:
+        if item["images"] and item["errors"]:
+            status = "partial"
+        elif item["images"]:
+            status = "success"
+        elif item["errors"]:
+            status = "error"
+        else:
+            status = "success_no_images"
+        entry = {
+            "index": item["index"],
+            "prompt_id": item["prompt_id"],
+            "status": status,
+            "images": item["images"],
+        }
+        if item["errors"]:
+            entry["errors"] = item["errors"]
+        results.append(entry)
+
+    failed = sum(1 for entry in results if entry["status"] == "error")
+    partial = sum(1 for entry in results if entry["status"] == "partial")
+    final_result = {
+        "items": results,
+        "succeeded": len(results) - failed - partial,
+        "partial": partial,
+        "failed": failed,
+    }
+    print(
+        f"worker-comfyui - Batch completed: {final_result['succeeded']} succeeded, "
+        f"{partial} partial, {failed} failed."
+    )
+    if results and failed == len(results):
+        final_result["error"] = "All batch items failed"
+    return final_result
+
+
+def _handle_introspection(what):
+    """
+    Answer an introspection request (``{"introspect": "models"}``) without running a
+    workflow. Supported topics: 'models', 'cache', 'memory', 'templates' and 'health'.
+    """
+    if what == "models":
+        if MODEL_INVENTORY is None or not MODEL_INVENTORY.available:
+            return {"error": f"Model index is not available ({MODEL_INDEX_DIR})"}
+        return {
+            "models": MODEL_INVENTORY.snapshot(),
+            "root": MODEL_INVENTORY.root,
+            "last_refresh": MODEL_INVENTORY.last_refresh,
+        }
+    if what == "cache":
+        if MODEL_CACHE is None:
+            return {"error": "Local model cache is disabled (set MODEL_CACHE_MAX_GB)"}
+        return {"cache": MODEL_CACHE.snapshot()}
+    if what == "memory":
+        if MEMORY_POLICY is None:
+            return {"error": "Memory policy is disabled"}
+        return {"memory": MEMORY_POLICY.snapshot()}
+    if what == "templates":
+        return {"templates": WORKFLOW_TEMPLATES.ids()}
+    if what == "health":
+        if COMFY_HEALTH is None:
+            return {"error": "Health monitor is not running"}
+        return {"health": COMFY_HEALTH.snapshot()}
+    return {"error": f"Unknown introspection topic '{what}' (use models, cache, memory, templates or health)"}
+
+
+def handler(job, control=None):
+    """
+    Handles a job using ComfyUI via websockets for status and image retrieval.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        control (JobControl, optional): Cancellation state shared with the caller;
+            created here when the handler is called directly.
+
+    Returns:
+        dict: A dictionary containing either an error message or a success status with generated images.
+    """
+    job_input = job["input"]
+    job_id = job["id"]
+
+    # Optional output controls and upload prefix for both remote and local flows
+    return_base64 = bool(job_input.get("return_base64", False))
+    path_from_request = job_input.get("path") or ""
+    path_from_request = str(path_from_request).strip().strip("/")
+    upload_prefix = "rp" if not path_from_request else f"rp/{path_from_request}"
+    gcs_bucket_creds, gcs_bucket_name = _load_gcs_bucket_creds()
+
+    # Local test mode: bypass ComfyUI network calls
+    if job_input.get("local", False) or os.environ.get("LOCAL_MODE", "false").lower() == "true":
+        return _handle_local_mode(job_input, upload_prefix, gcs_bucket_creds, gcs_bucket_name)
+
+    # Lightweight introspection requests don't touch ComfyUI at all
+    if job_input.get("introspect"):
+        return _handle_introspection(job_input["introspect"])
+
+    # Validate input for remote (ComfyUI) flow
+    validated_data, error_message = validate_input(job_input)
+    if error_message:
+        return {"error": error_message}
+
+    workflows = validated_data["workflows"]
+    is_batch = validated_data["batch"]
+    input_images = validated_data.get("images")
+
+    # Reject jobs that reference models which are not on the volume before queueing
+    if MODEL_INDEX_ENFORCE and MODEL_INVENTORY is not None:
+        missing = MODEL_INVENTORY.missing_models(workflows)
+        if missing:
+            return {
+                "error": "Workflow references models that are not available",
+                "details": missing,
+            }
+
+    if MODEL_CACHE is not None:
+        MODEL_CACHE.record_workflows(workflows)
+
+    if control is None:
+        control = JobControl(job_id)
+    timeout_s = validated_data.get("timeout_s")
+    control.set_timeout(COMFY_JOB_TIMEOUT_S if timeout_s is None else timeout_s)
+
+    # If the supervisor is restarting ComfyUI, hold the job briefly instead of failing it
+    if COMFY_SUPERVISOR is not None and not COMFY_SUPERVISOR.is_ready():
+        print(
+            f"worker-comfyui - ComfyUI is restarting, waiting up to {COMFY_RESTART_WAIT_S}s..."
+        )
+        if not COMFY_SUPERVISOR.wait_until_ready(COMFY_RESTART_WAIT_S):
+            return {
+                "error": f"ComfyUI did not come back within {COMFY_RESTART_WAIT_S}s after a crash.",
+                "details": COMFY_SUPERVISOR.log_tail(50),
+            }
+
+    # Make sure that the ComfyUI HTTP API is available before proceeding. The background
+    # monitor keeps this an O(1) flag lookup; only an unhealthy flag triggers a probe.
+    if COMFY_HEALTH is not None:
+        healthy, reason = COMFY_HEALTH.status()
+        if not healthy:
+            # The cached state may predate a restart – re-probe once before failing fast
+            healthy, reason = COMFY_HEALTH.probe_now()
+        if not healthy:
+            return {
+                "error": f"ComfyUI server ({COMFY_HOST}) is unhealthy: {COMFY_HEALTH_REASONS.get(reason, reason)}",
+                "details": COMFY_HEALTH.snapshot(),
+            }
+    elif not check_server(
+        f"http://{COMFY_HOST}/",
+        COMFY_API_AVAILABLE_MAX_RETRIES,
+        COMFY_API_AVAILABLE_INTERVAL_MS,
+    ):
+        return {
+            "error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."
+        }
+
+    # Upload input images if they exist; URLs and bucket keys are fetched concurrently
+    placed_inputs = []
+    if input_images:
+        remote_images = [image for image in input_images if _is_remote_image(image)]
+        inline_images = [image for image in input_images if not _is_remote_image(image)]
+        if remote_images:
+            budget_s = INPUT_FETCH_BUDGET_S
+            if control.remaining() is not None:
+                budget_s = max(0, min(budget_s, control.remaining()))
+            fetch_result = REMOTE_INPUTS.fetch_all(
+                remote_images, gcs_bucket_creds, gcs_bucket_name, budget_s
+            )
+            placed_inputs = fetch_result["placed"]
+            if fetch_result["status"] == "error":
+                REMOTE_INPUTS.release(placed_inputs)
+                return {
+                    "error": "Failed to fetch one or more input images",
+                    "details": fetch_result["details"],
+                }
+        upload_result = upload_images(inline_images)
+        if upload_result["status"] == "error":
+            REMOTE_INPUTS.release(placed_inputs)
+            # Return upload errors
+            return {
+                "error": "Failed to upload one or more input images",
+                "details": upload_result["details"],
+            }
+
+    # Free ComfyUI memory before queueing if the next job would not fit comfortably.
+    # Runs only once ComfyUI is known healthy and the job is about to be queued.
+    if MEMORY_POLICY is not None:
+        MEMORY_POLICY.before_job(
+            workflows, COMFY_SUPERVISOR.generation if COMFY_SUPERVISOR is not None else None
+        )
+
+    dedup = bool(job_input.get("dedup", OUTPUT_DEDUP))
+    upload_stats = {"hits": 0, "uploads": 0, "bytes_saved": 0}
+    delivered_outputs = set()
+    items = [{"index": i, "workflow": wf} for i, wf in enumerate(workflows)]
+    max_submissions = 2 if job_input.get("resubmit_on_crash", COMFY_RESUBMIT_ON_CRASH) else 1
+
+    try:
+        for submission in range(max_submissions):
+            generation = COMFY_SUPERVISOR.generation if COMFY_SUPERVISOR is not None else 0
+            try:
+                _execute_workflows(items, control, raise_queue_errors=not is_batch)
+                break
+            except ComfyUICrashedError as crash:
+                if submission + 1 >= max_submissions:
+                    raise
                 print(
-                    f"worker-comfyui - --> If this output is useful, please consider opening an issue on GitHub to discuss adding support."
+                    f"worker-comfyui - {crash}. Waiting up to {COMFY_RESTART_WAIT_S}s for restart before resubmitting..."
                 )
-
+                if not COMFY_SUPERVISOR.wait_for_restart(generation, COMFY_RESTART_WAIT_S):
+                    raise
+                print("worker-comfyui - ComfyUI restarted, resubmitting workflow once.")
+
+        # Fetch outputs even if there were execution errors, some outputs might exist
+        for item in items:
+            item["images"] = []
+            if not item["prompt_id"]:
+                continue
+            control.check()
+            try:
+                item["images"] = _collect_outputs(
+                    item["prompt_id"],
+                    item["errors"],
+                    return_base64,
+                    gcs_bucket_creds,
+                    gcs_bucket_name,
+                    upload_prefix,
+                    dedup,
+                    upload_stats,
+                    delivered_outputs,
+                    control,
+                )
+            except requests.RequestException as e:
+                if not is_batch:
+                    raise
+                item["errors"].append(f"Error fetching outputs: {e}")
+
+        # Items of one job may share a cached output file, so discard only after all
+        # of them were collected
+        if OUTPUT_CLEANUP and OUTPUT_JANITOR is not None:
+            for path in delivered_outputs:
+                OUTPUT_JANITOR.discard(path)
+
+    except JobCancelledError as e:
+        print(f"worker-comfyui - Job {job_id} stopped: {e.reason}")
+        return {
+            "error": f"Job {e.reason}",
+            "details": {"prompt_ids": e.prompt_ids},
+        }
+    except ComfyUICrashedError as e:
+        print(f"worker-comfyui - ComfyUI crash: {e}")
+        return {
+            "error": f"ComfyUI crashed while processing the job: {e}",
+            "details": e.log_tail,
+        }
     except websocket.WebSocketException as e:
         print(f"worker-comfyui - WebSocket Error: {e}")
         print(traceback.format_exc())
@@ -905,11 +3515,25 @@ def handler(job):
         print(traceback.format_exc())
         return {"error": f"An unexpected error occurred: {e}"}
     finally:
-        if ws and ws.connected:
-            print(f"worker-comfyui - Closing websocket connection.")
-            ws.close()
+        # Remote inputs were placed for this job only
+        REMOTE_INPUTS.release(placed_inputs)
+
+    if dedup:
+        print(
+            f"worker-comfyui - Dedup: {upload_stats['hits']} hit(s), {upload_stats['uploads']} upload(s), {upload_stats['bytes_saved']} bytes saved"
+        )
+
+    if is_batch:
+        final_result = _batch_result(items)
+        if dedup:
+            final_result["dedup"] = upload_stats
+        return final_result
 
+    output_data = items[0]["images"]
+    errors = items[0]["errors"]
     final_result = {}
+    if dedup:
+        final_result["dedup"] = upload_stats
 
     if output_data:
         final_result["images"] = output_data
@@ -935,6 +3559,29 @@ def handler(job):
     return final_result
 
 
+async def cancellable_handler(job):
+    """
+    RunPod entry point that keeps jobs cancellable.
+
+    The blocking :func:`handler` runs in a worker thread so RunPod's event loop stays
+    free to deliver stop signals. When RunPod cancels the job (user cancel or
+    execution timeout) the job's prompts are interrupted/dequeued in ComfyUI and the
+    cancellation is propagated immediately instead of waiting for the thread.
+    """
+    control = JobControl(job["id"])
+    try:
+        return await asyncio.to_thread(handler, job, control)
+    except asyncio.CancelledError:
+        # Stopping prompts does HTTP calls – don't hold up RunPod's event loop with them
+        threading.Thread(
+            target=control.cancel,
+            args=("was cancelled by RunPod",),
+            name=f"cancel-{job['id']}",
+            daemon=True,
+        ).start()
+        raise
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run ComfyUI handler")
     parser.add_argument("--local", action="store_true", help="Run in local test mode (no ComfyUI)")
@@ -968,5 +3615,49 @@ if __name__ == "__main__":
         result = handler(job)
         print(json.dumps(result, indent=2))
     else:
+        MODEL_INVENTORY = ModelInventory(
+            MODEL_INDEX_DIR,
+            hash_files=MODEL_INDEX_HASH,
+            cache_path=MODEL_INDEX_CACHE_PATH,
+        )
+        MODEL_INVENTORY.start()
+
+        comfy_args = list(COMFY_EXTRA_ARGS)
+        if MODEL_CACHE_MAX_GB > 0:
+            if COMFY_SUPERVISOR_ENABLED:
+                MODEL_CACHE = ModelCache(
+                    MODEL_CACHE_DIR, int(MODEL_CACHE_MAX_GB * 1e9), MODEL_INVENTORY
+                )
+                MODEL_CACHE.start()
+                config_path = MODEL_CACHE.write_extra_model_paths(
+                    MODEL_INVENTORY.names_by_category().keys()
+                )
+                comfy_args += ["--extra-model-paths-config", config_path]
+            else:
+                print(
+                    "worker-comfyui - MODEL_CACHE_MAX_GB is set but COMFY_SUPERVISOR is off – local model cache disabled"
+                )
+
+        if COMFY_SUPERVISOR_ENABLED:
+            COMFY_SUPERVISOR = ComfyUISupervisor(
+                COMFY_APP_DIR, COMFY_LOG_PATH, comfy_args, COMFY_LOG_TAIL_LINES
+            )
+            atexit.register(COMFY_SUPERVISOR.stop)
+            COMFY_SUPERVISOR.start()
+            print(
+                f"worker-comfyui - Waiting for ComfyUI to start (up to {COMFY_STARTUP_TIMEOUT_S}s)..."
+            )
+            if not COMFY_SUPERVISOR.wait_until_ready(COMFY_STARTUP_TIMEOUT_S):
+                print(f"worker-comfyui - ComfyUI failed to start on {COMFY_HOST}")
+                for line in COMFY_SUPERVISOR.log_tail(50):
+                    print(f"    {line}")
+                sys.exit(1)
+        if MEMORY_POLICY_ENABLED:
+            MEMORY_POLICY = ModelResidencyPolicy()
+        OUTPUT_JANITOR = OutputJanitor()
+        OUTPUT_JANITOR.start()
+        COMFY_HEALTH = ComfyUIHealthMonitor(COMFY_SUPERVISOR)
+        COMFY_HEALTH.probe_now()
+        COMFY_HEALTH.start()
         print("worker-comfyui - Starting handler...")
-        runpod.serverless.start({"handler": handler})
+        runpod.serverless.start({"handler": cancellable_handler})
@@ -6,6 +6,8 @@ VOL=/runpod-volume
 # но мы создали симлинк /workspace/ComfyUI -> /ComfyUI для совместимости
 APP=/workspace/ComfyUI
 BASE_COMFYUI=/ComfyUI
+# По умолчанию ComfyUI запускает и перезапускает супервизор внутри handler.py
+export COMFY_SUPERVISOR="${COMFY_SUPERVISOR:-true}"
 
 echo "🚀 Optimized ComfyUI startup with volume mounting (template v8 compatible)..."
 
@@ -105,6 +107,13 @@ fi
 echo "🐍 Проверяем возможность импорта ComfyUI модулей:"
 python -c "import sys; sys.path.append('.'); import folder_paths; print('✅ folder_paths импортирован')" 2>/dev/null || echo "⚠️ Проблемы с импортом folder_paths"
 
+if [ "$COMFY_SUPERVISOR" = "true" ]; then
+    # handler.py сам запустит ComfyUI, дождётся порта 8188 и будет перезапускать его при падении
+    echo "🛡️ ComfyUI запускается супервизором handler.py (COMFY_SUPERVISOR=true)"
+    export COMFY_APP_DIR="$APP"
+    exec python -u /handler.py
+fi
+
 echo "🚀 Запускаем ComfyUI с логированием..."
 python -u main.py --verbose > /tmp/comfyui.log 2>&1 &
 COMFY_PID=$!
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Check the memory residency policy of handler.py against a stub ComfyUI server.
+
+The stub reproduces how ComfyUI treats POST /free: only truthy flags are stored,
+and the prompt worker unloads every model when ``unload_models`` is set or, if it
+is absent, when ``free_memory`` is set. After every job the policy's view of the
+resident models must match what the stub actually has loaded.
+
+Usage: python test-memory-policy.py
+"""
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import handler  # noqa: E402
+
+
+class StubComfyUI:
+    def __init__(self):
+        self.system_stats = {}
+        self.flags = {}
+        self.loaded = set()
+        self.free_requests = []
+
+    def post_free(self, body):
+        # server.py: set_flag() is only called for truthy values
+        self.free_requests.append(body)
+        for flag in ("unload_models", "free_memory"):
+            if body.get(flag, False):
+                self.flags[flag] = body[flag]
+
+    def run_job(self, models):
+        # main.py prompt_worker: flags are applied before the next prompt runs
+        flags, self.flags = self.flags, {}
+        free_memory = flags.get("free_memory", False)
+        if flags.get("unload_models", free_memory):
+            self.loaded.clear()
+        self.loaded |= set(models)
+
+    def restart(self):
+        self.flags = {}
+        self.loaded.clear()
+
+
+def serve(stub):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._reply(stub.system_stats)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            stub.post_free(json.loads(self.rfile.read(length) or b"{}"))
+            self._reply({})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def system_stats(ram_used, vram_used):
+    return {
+        "system": {"ram_total": 100, "ram_free": 100 - ram_used},
+        "devices": [{"type": "cuda", "vram_total": 100, "vram_free": 100 - vram_used}],
+    }
+
+
+def checkpoint(name):
+    return {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": name}}}
+
+
+# (description, ram %, vram %, checkpoint, ComfyUI generation, expected /free body)
+SCENARIOS = [
+    ("first job", 10, 10, "a.safetensors", 1, None),
+    ("same family, RAM pressure", 90, 10, "a.safetensors", 1, None),
+    ("same family, VRAM pressure", 10, 95, "a.safetensors", 1, None),
+    ("switch without pressure", 10, 10, "b.safetensors", 1, None),
+    ("switch, VRAM pressure", 10, 95, "c.safetensors", 1, {"unload_models": True}),
+    ("switch, RAM pressure", 90, 10, "d.safetensors", 1,
+     {"unload_models": True, "free_memory": True}),
+    ("after a ComfyUI restart", 10, 95, "e.safetensors", 2, None),
+]
+
+
+def main():
+    stub = StubComfyUI()
+    server = serve(stub)
+    policy = handler.ModelResidencyPolicy(
+        host=f"127.0.0.1:{server.server_address[1]}", ram_high=0.85, vram_high=0.9
+    )
+    ok = True
+    generation = 1
+    try:
+        for description, ram_used, vram_used, name, job_generation, expected in SCENARIOS:
+            if job_generation != generation:
+                stub.restart()
+                generation = job_generation
+            stub.system_stats = system_stats(ram_used, vram_used)
+            stub.free_requests.clear()
+            policy.before_job([checkpoint(name)], generation)
+            stub.run_job([name])
+
+            sent = stub.free_requests[0] if stub.free_requests else None
+            passed = sent == expected and policy.resident == stub.loaded
+            ok = ok and passed
+            print(
+                f"{'PASS' if passed else 'FAIL'} {description}: sent {sent}, "
+                f"policy resident {sorted(policy.resident)}, loaded {sorted(stub.loaded)}"
+            )
+    finally:
+        server.shutdown()
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)